@@ -0,0 +1,71 @@
+import json
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+
+def send_json(request, value, status=200):
+    body = json.dumps(without_nan(value), separators=(',', ':')).encode()
+    request.send_response(status)
+    request.send_header('Content-Type', 'application/json')
+    request.send_header('Content-Length', str(len(body)))
+    request.end_headers()
+    request.wfile.write(body)
+
+
+def without_nan(value):
+    # NaN marks a missing value, it goes out as null to stay valid JSON
+    if isinstance(value, float):
+        return None if math.isnan(value) else value
+    if isinstance(value, dict):
+        return {key: without_nan(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [without_nan(item) for item in value]
+    return value
+
+
+class ApiServer:
+    # Local HTTP server for consumers that should not have to go through
+    # InfluxDB or MQTT. Handlers are added per path prefix and called as
+    # handler(request, path, params) on the request's own thread, params
+    # holding the last value of every query parameter. A handler raising
+    # KeyError answers 404 and ValueError 400.
+
+    def __init__(self, host='127.0.0.1', port=9110):
+        self.routes = {}
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                prefix = max((prefix for prefix in routes
+                              if url.path == prefix or url.path.startswith(prefix + '/')), key=len, default=None)
+                if prefix is None:
+                    self.send_error(404)
+                    return
+                try:
+                    routes[prefix](self, url.path[len(prefix):].strip('/'), dict(parse_qsl(url.query)))
+                except KeyError as err:
+                    send_json(self, {'error': 'Not found: %s' % err}, 404)
+                except ValueError as err:
+                    send_json(self, {'error': str(err)}, 400)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='api', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Returns None when the [api] section is missing
+        if not settings.has_section('api'):
+            return None
+        return cls(settings.get('api', 'host', fallback='127.0.0.1'),
+                   settings.getint('api', 'port', fallback=9110))
+
+    def route(self, prefix, handler):
+        self.routes['/' + prefix.strip('/')] = handler
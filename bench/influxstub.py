@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+
+# A stand-in for the InfluxDB 1.x HTTP API that can be switched on and off,
+# to exercise the writer and its spool without a real database.
+#
+#   python3 -m bench.influxstub --port 8086 --toggle 30
+
+import argparse
+import gzip
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+
+class InfluxStub:
+    def __init__(self, host='127.0.0.1', port=0, delay=0):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        # Status writes are answered with, eg. 400 for a field type conflict
+        # or 500 for a failing database
+        self.status = 204
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.points = 0
+        self.bytes = 0
+        self.latencies = []
+
+    @property
+    def online(self):
+        return self.server is not None
+
+    def start(self):
+        if self.server is not None:
+            return
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, format, *args):
+                pass
+
+            def reply(self, code, body=b''):
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                path = urlparse(self.path).path
+                if path == '/ping':
+                    self.reply(204)
+                else:
+                    self.reply(200, json.dumps({'results': [{'statement_id': 0}]}).encode())
+
+            def do_POST(self):
+                started = time.perf_counter()
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                if stub.delay:
+                    time.sleep(stub.delay)
+                if urlparse(self.path).path == '/write' and stub.status != 204:
+                    self.reply(stub.status, json.dumps({'error': 'stub answers %d' % stub.status}).encode())
+                elif urlparse(self.path).path == '/write':
+                    with stub.lock:
+                        stub.requests += 1
+                        stub.bytes += len(body)
+                        stub.points += sum(1 for line in body.splitlines() if line.strip())
+                        stub.latencies.append(time.perf_counter() - started)
+                    self.reply(204)
+                else:
+                    self.do_GET()
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        # Keep the same port across restarts
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='influxstub', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='InfluxDB stub server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--toggle', type=float, default=0, help='switch on and off every N seconds')
+    args = parser.parse_args()
+
+    stub = InfluxStub(args.host, args.port)
+    stub.start()
+    print('Listening on %s:%d' % (stub.host, stub.port))
+    while True:
+        time.sleep(args.toggle or 10)
+        if args.toggle:
+            if stub.online:
+                stub.stop()
+            else:
+                stub.start()
+        print('%s, %d requests, %d points' % ('online' if stub.online else 'offline', stub.requests, stub.points))
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+# Simulated Growatt inverters and PZEM-004T meters answering Modbus reads,
+# over TCP (Modbus TCP or RTU frames) or a pty standing in for a serial
+# line, to exercise solarmon without hardware.
+#
+#   python3 -m bench.modbusslave --transport pty --growatt 1 --pzem 2
+
+import argparse
+import math
+import os
+import socketserver
+import struct
+import threading
+import time
+import tty
+from array import array
+from datetime import datetime
+
+import growatt
+import pzem
+
+# Modbus exception codes
+IllegalFunction = 1
+IllegalAddress = 2
+
+
+def crc16(data):
+    crc = 0xFFFF
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+    return struct.pack('<H', crc)
+
+
+def encode(fields, values, size, low_word_first=False):
+    # Register block of size registers holding values, the reverse of
+    # RegisterDecoder.decode()
+    registers = array('H', bytes(size * 2))
+    for field in fields:
+        value = values.get(field.name, 0)
+        raw = int(round(value if field.scale is None else value * field.scale))
+        if field.width == 1:
+            registers[field.address] = raw & 0xFFFF
+        else:
+            high, low = (raw >> 16) & 0xFFFF, raw & 0xFFFF
+            words = (low, high) if low_word_first else (high, low)
+            registers[field.address], registers[field.address + 1] = words
+    return registers
+
+
+class SimulatedGrowatt:
+    # Values follow a slow sine so consecutive samples differ, like a real
+    # inverter on a sunny day
+    InputSize = 125
+    HoldingSize = 125
+
+    def __init__(self, unit, power=3000, unsupported=()):
+        self.unit = unit
+        self.power = power
+        # Input registers this model does not have, reads of them fail
+        self.unsupported = set(unsupported)
+        self.started = time.time()
+        self.holding = array('H', bytes(self.HoldingSize * 2))
+        self.holding[73] = 1
+        # Firmware, control firmware and serial number, two characters a register
+        for address, value in ((9, b'DH1.0 '), (12, b'ZA1.0 '), (23, b'SIM%07d' % unit)):
+            for offset in range(0, len(value), 2):
+                self.holding[address + offset // 2] = int.from_bytes(value[offset:offset + 2], 'big')
+        self.holding[28:30] = array('H', [0x1104, 0x0501])
+        # (code, datetime, value) of the fault history, newest first
+        self.faults = [(25, datetime(2024, 6, 21, 5, 42, 7), 0), (30, datetime(2024, 5, 2, 13, 5, 59), 2581)]
+
+    def values(self, now):
+        level = 0.6 + 0.4 * math.sin((now - self.started) / 60)
+        ppv = self.power * level
+        pac = ppv * 0.96
+        return {
+            'StatusCode': 1, 'Ppv': ppv,
+            'Vpv1': 350 + 10 * level, 'PV1Curr': ppv / 2 / 350, 'PV1Watt': ppv / 2,
+            'Vpv2': 348 + 10 * level, 'PV2Curr': ppv / 2 / 348, 'PV2Watt': ppv / 2,
+            'Pac': pac, 'Fac': 50 + 0.02 * math.sin(now), 'Vac1': 230 + 2 * math.sin(now / 7),
+            'Iac1': pac / 230, 'Pac1': pac,
+            'EnergyToday': (now - self.started) * pac / 3600000, 'EnergyTotal': 12345.6,
+            'TimeTotal': now - self.started, 'Temp': 35 + 10 * level, 'IPMTemp': 40 + 10 * level,
+            'PBusV': 380, 'NBusV': 380, 'Epv1_today': 1.5, 'Epv2_today': 1.4, 'Epv_total': 12000,
+        }
+
+    def input(self):
+        registers = encode(growatt.InputRegisters, self.values(time.time()), self.InputSize)
+        for index, (code, when, value) in enumerate(self.faults[:growatt.FaultRecords]):
+            address = growatt.FaultTable + index * growatt.FaultRecordWidth
+            registers[address:address + growatt.FaultRecordWidth] = array('H', [
+                code, (when.year - 2000) << 8 | when.month, when.day << 8 | when.hour,
+                when.minute << 8 | when.second, value])
+        return registers
+
+
+class SimulatedPzem:
+    InputSize = 10
+    HoldingSize = 4
+
+    def __init__(self, unit, load=1500):
+        self.unit = unit
+        self.load = load
+        self.started = time.time()
+        self.holding = array('H', bytes(self.HoldingSize * 2))
+        self.holding[2] = unit
+        self.unsupported = set()
+
+    def input(self):
+        now = time.time()
+        power = self.load * (1 + 0.2 * math.sin(now / 5))
+        voltage = 230 + 3 * math.sin(now / 11)
+        return encode(pzem.InputRegisters, {
+            'Voltage': voltage, 'Current': power / voltage, 'Power': power,
+            'Total': 1000 + (now - self.started) * power / 3600000,
+            'Frequency': 50, 'Factor': 0.95, 'Alarm': 0,
+        }, self.InputSize, low_word_first=True)
+
+
+class Slave:
+    # Answers read input (4) and read holding (3) register requests for a
+    # set of units. delay is added before every answer, like the time a
+    # unit takes to respond.
+
+    def __init__(self, devices, delay=0):
+        self.devices = {device.unit: device for device in devices}
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def handle(self, unit, pdu):
+        # Response PDU for a request PDU, None for units that are not there
+        device = self.devices.get(unit)
+        if device is None:
+            return None
+        with self.lock:
+            self.requests += 1
+        if self.delay:
+            time.sleep(self.delay)
+
+        function = pdu[0]
+        if function not in (3, 4) or len(pdu) < 5:
+            return self.exception(function, IllegalFunction)
+        address, count = struct.unpack('>HH', pdu[1:5])
+        registers = device.input() if function == 4 else device.holding
+        if count < 1 or count > 125 or address + count > len(registers) \
+                or function == 4 and any(address <= register < address + count for register in device.unsupported):
+            return self.exception(function, IllegalAddress)
+        block = registers[address:address + count]
+        return bytes([function, count * 2]) + struct.pack('>%dH' % count, *block)
+
+    def exception(self, function, code):
+        with self.lock:
+            self.errors += 1
+        return bytes([function | 0x80, code])
+
+
+def read_exactly(read, size):
+    data = b''
+    while len(data) < size:
+        chunk = read(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def serve_rtu(slave, read, write):
+    # Read requests are always 8 bytes: unit, function, address, count, crc
+    while True:
+        frame = read_exactly(read, 8)
+        if frame is None:
+            return
+        if crc16(frame[:6]) != frame[6:]:
+            continue
+        pdu = slave.handle(frame[0], frame[1:6])
+        if pdu is not None:
+            reply = bytes([frame[0]]) + pdu
+            write(reply + crc16(reply))
+
+
+def serve_tcp(slave, read, write):
+    # MBAP header: transaction, protocol, length, unit
+    while True:
+        header = read_exactly(read, 7)
+        if header is None:
+            return
+        transaction, protocol, length, unit = struct.unpack('>HHHB', header)
+        request = read_exactly(read, length - 1)
+        if request is None:
+            return
+        pdu = slave.handle(unit, request)
+        if pdu is not None:
+            write(struct.pack('>HHHB', transaction, protocol, len(pdu) + 1, unit) + pdu)
+
+
+class TcpSlave:
+    # framing 'tcp' for Modbus TCP, 'rtu' for an RTU to Ethernet gateway
+    # passing frames through
+
+    def __init__(self, slave, host='127.0.0.1', port=0, framing='tcp'):
+        serve = serve_tcp if framing == 'tcp' else serve_rtu
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                serve(slave, self.request.recv, self.request.sendall)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, name='modbus-tcp', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class PtySlave:
+    # A pty pair standing in for an RS485 adapter, clients open self.port.
+    # With a baudrate every frame takes as long as it would on the line.
+
+    def __init__(self, slave, baudrate=None):
+        self.master, self.slave_fd = os.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+        self.baudrate = baudrate
+        self.thread = threading.Thread(target=serve_rtu, args=(slave, self.read, self.write),
+                                       name='modbus-pty', daemon=True)
+        self.thread.start()
+
+    def line_time(self, size):
+        # 10 bits per byte with start and stop bit
+        if self.baudrate:
+            time.sleep(size * 10 / self.baudrate)
+
+    def read(self, size):
+        try:
+            data = os.read(self.master, size)
+        except OSError:
+            return b''
+        self.line_time(len(data))
+        return data
+
+    def write(self, data):
+        self.line_time(len(data))
+        os.write(self.master, data)
+
+    def stop(self):
+        os.close(self.master)
+        os.close(self.slave_fd)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulated Growatt and PZEM-004T Modbus units')
+    parser.add_argument('--transport', choices=['tcp', 'rtu-over-tcp', 'pty'], default='tcp')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--growatt', type=int, default=1, help='number of inverters, units 1 and up')
+    parser.add_argument('--pzem', type=int, default=0, help='number of meters, units after the inverters')
+    parser.add_argument('--delay', type=float, default=0, help='seconds each unit takes to answer')
+    parser.add_argument('--baudrate', type=int, default=0, help='simulated line speed of the pty')
+    args = parser.parse_args()
+
+    devices = [SimulatedGrowatt(unit) for unit in range(1, args.growatt + 1)]
+    devices += [SimulatedPzem(unit) for unit in range(args.growatt + 1, args.growatt + args.pzem + 1)]
+    slave = Slave(devices, args.delay)
+    if args.transport == 'pty':
+        server = PtySlave(slave, args.baudrate)
+        print('Serving units %s on %s' % (sorted(slave.devices), server.port))
+    else:
+        server = TcpSlave(slave, args.host, args.port, 'tcp' if args.transport == 'tcp' else 'rtu')
+        print('Serving units %s on %s:%d' % (sorted(slave.devices), server.host, server.port))
+    while True:
+        time.sleep(10)
+        print('%d requests, %d errors' % (slave.requests, slave.errors))
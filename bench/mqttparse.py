@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+# Messages per second of the MQTT payload parsing, the per field int/float
+# conversion the scripts used before against the compiled schema, both on
+# the stdlib json and truncating like the scripts do by default, and of
+# the callback queue drained one message or one batch at a time.
+# solarmon-mqtt.py only needs the fields, process_mqtt.py also the time.
+#
+#   python3 -m bench.mqttparse --messages 200000
+
+import argparse
+import json
+import threading
+import time
+
+import payload
+from payload import Ingest, Schema, TasmotaEnergy, json_loads
+from streamjoin import message_time
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def sample(i):
+    return json.dumps({
+        'Time': '2020-07-01T12:00:%02d' % (i % 60),
+        'ENERGY': {
+            'TotalStartTime': '2020-01-01T00:00:00',
+            'Total': 1234.567 + i / 1000,
+            'Yesterday': 12.345,
+            'Today': 6.789,
+            'Period': i % 10,
+            'Power': 1500 + i % 100,
+            'ApparentPower': 1600,
+            'ReactivePower': 300,
+            'Factor': 0.94,
+            'Voltage': 230 + i % 5,
+            'Current': 6.52,
+        },
+    }).encode()
+
+
+def legacy(message):
+    # The parser solarmon-mqtt.py and process_mqtt.py used before
+    return legacy_fields(json.loads(message.decode("utf-8")))
+
+
+def legacy_timed(message):
+    # process_mqtt.py also took the time from the message
+    mqtt_message = json.loads(message.decode("utf-8"))
+    return message_time(mqtt_message, time.time()), legacy_fields(mqtt_message)
+
+
+def legacy_fields(mqtt_message):
+    energy = mqtt_message["ENERGY"]
+    energy_parsed = {}
+    for k, v in energy.items():
+        try:
+            energy_parsed[k] = int(v)
+        except ValueError:
+            try:
+                energy_parsed[k] = float(v)
+            except ValueError:
+                pass
+    return energy_parsed
+
+
+def rates(parsers, messages, repeat=5):
+    # Best rate of each (name, parse) over repeat rounds. The parsers take
+    # turns within a round, so a noisy machine does not favour one of them.
+    best = dict.fromkeys([name for name, _ in parsers], 0)
+    for _ in range(repeat):
+        for name, parse in parsers:
+            started = time.perf_counter()
+            for message in messages:
+                parse(message)
+            best[name] = max(best[name], len(messages) / (time.perf_counter() - started))
+    return best
+
+
+def queued(messages, batch_size):
+    # Push every message through Ingest and wait for the worker to finish
+    ingest = Ingest(batch_size)
+    done = threading.Event()
+    left = [len(messages)]
+
+    def handle(payload):
+        left[0] -= 1
+        if not left[0]:
+            done.set()
+
+    callback = ingest.callback(handle)
+    started = time.perf_counter()
+    for message in messages:
+        callback(None, None, message)
+    done.wait()
+    return len(messages) / (time.perf_counter() - started)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MQTT payload parsing benchmark')
+    parser.add_argument('--messages', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    payloads = [sample(i) for i in range(args.messages)]
+    schema = Schema(TasmotaEnergy, loads=json_loads, truncate=True)
+    parsers = [
+        ('json, int/float per field', legacy),
+        ('json, schema', schema.parse_fields),
+        ('json, int/float, time', legacy_timed),
+        ('json, schema, time', lambda message: schema.parse(message, time.time())),
+    ]
+    if payload.loads is not json_loads:
+        parsers.append(('orjson, schema', Schema(TasmotaEnergy, truncate=True).parse_fields))
+    for name, value in rates(parsers, payloads).items():
+        print('%-28s %10.0f msg/s' % (name, value))
+
+    messages = [Message('tele/pzem004t/SENSOR', p) for p in payloads]
+    print('%-28s %10.0f msg/s' % ('queue, batch of 1', queued(messages, 1)))
+    print('%-28s %10.0f msg/s' % ('queue, batch of %d' % args.batch, queued(messages, args.batch)))
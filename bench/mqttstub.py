@@ -0,0 +1,57 @@
+# A stand-in for a paho client connected to a broker. Published messages
+# are counted and delivered to the subscribed callbacks on a loop thread,
+# the way paho's network thread would, without a broker in between.
+
+import queue
+import threading
+
+
+class MessageInfo:
+    def __init__(self, rc=0):
+        self.rc = rc
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class MqttStub:
+    def __init__(self):
+        self.on_message = None
+        self.callbacks = {}
+        self.queue = queue.SimpleQueue()
+        self.lock = threading.Lock()
+        self.published = 0
+        self.delivered = 0
+        self.bytes = 0
+        self.thread = None
+
+    def message_callback_add(self, topic, callback):
+        self.callbacks[topic] = callback
+
+    def subscribe(self, topic, qos=0):
+        pass
+
+    def loop_start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop, name='mqttstub', daemon=True)
+            self.thread.start()
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode()
+        with self.lock:
+            self.published += 1
+            self.bytes += len(payload or b'')
+        self.queue.put(Message(topic, payload))
+        return MessageInfo()
+
+    def loop(self):
+        while True:
+            message = self.queue.get()
+            callback = self.callbacks.get(message.topic, self.on_message)
+            if callback is not None:
+                callback(self, None, message)
+            self.delivered += 1
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+# Runs the solarmon pipeline against simulated inverters and meters, an
+# InfluxDB stub and an MQTT stand-in, and reports polls per second,
+# transaction latency, decode cost and sink throughput. Run it before and
+# after a change to catch regressions.
+#
+#   python3 -m bench.run --inverters 2 --meters 1 --seconds 10
+#   python3 -m bench.run --mode mqtt --transport pty --baudrate 9600
+
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+import timeit
+from configparser import RawConfigParser
+from datetime import datetime
+
+import influxwriter
+import pzem
+from bench.influxstub import InfluxStub
+from bench.modbusslave import PtySlave, SimulatedGrowatt, SimulatedPzem, Slave, TcpSlave
+from bench.mqttstub import MqttStub
+from deadband import Deadband
+from gridmeter import GridMeter
+from growatt import Growatt, InputDecoders
+from influxwriter import InfluxWriter
+from mqttsink import MqttSink
+from payload import Ingest
+from poller import Device, LatestValues, Poller
+from pzem import Pzem
+from rollup import Rollup
+from transport import device_bus, load_buses
+
+GrowattTopic = 'tele/growatt/SENSOR'
+PzemTopic = 'tele/pzem004t/SENSOR'
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Timed:
+    # Wraps a bus client and times every transaction
+    def __init__(self, client):
+        self.client = client
+        self.size = client.size
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.errors = 0
+
+    def call(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        response = getattr(self.client, method)(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies.append(elapsed)
+            if response.isError():
+                self.errors += 1
+        return response
+
+    def read_input_registers(self, *args, **kwargs):
+        return self.call('read_input_registers', *args, **kwargs)
+
+    def read_holding_registers(self, *args, **kwargs):
+        return self.call('read_holding_registers', *args, **kwargs)
+
+
+class Counter:
+    # Sink counting the samples of every device
+    def __init__(self):
+        self.samples = {}
+
+    def put(self, name, point):
+        self.samples[name] = self.samples.get(name, 0) + 1
+
+
+def start_buses(args):
+    # One simulated line per bus, inverters are units 1 and up on every bus
+    # and the meters follow them
+    servers = []
+    for number in range(args.buses):
+        inverters = len(range(number, args.inverters, args.buses))
+        meters = len(range(number, args.meters, args.buses))
+        devices = [SimulatedGrowatt(unit) for unit in range(1, inverters + 1)]
+        devices += [SimulatedPzem(unit) for unit in range(inverters + 1, inverters + meters + 1)]
+        slave = Slave(devices, args.delay)
+        if args.transport == 'pty':
+            servers.append((slave, PtySlave(slave, args.baudrate)))
+        else:
+            servers.append((slave, TcpSlave(slave, framing='tcp' if args.transport == 'tcp' else 'rtu')))
+    return servers
+
+
+def bench_settings(args, stub, servers):
+    settings = RawConfigParser()
+    settings.read_dict({
+        'influx': {'host': stub.host, 'port': stub.port, 'db_name': 'bench', 'spool': '',
+                   'batch_size': args.batch_size, 'flush_interval': 1},
+        'rates': {'energy': 60, 'fault': 300},
+        # Inverter samples stay joinable for longer than the short bench interval
+        'mqtt': {'max_age': 5},
+    })
+    for number, (slave, server) in enumerate(servers):
+        bus = 'bus.sim%d' % number
+        if args.transport == 'pty':
+            settings[bus] = {'port': server.port, 'baudrate': args.baudrate or 9600, 'timeout': 1}
+        else:
+            settings[bus] = {'transport': args.transport, 'host': server.host, 'port': server.port,
+                             'timeout': 1}
+        for unit, device in slave.devices.items():
+            kind = 'inverters' if isinstance(device, SimulatedGrowatt) else 'meters'
+            settings['%s.sim%d_%d' % (kind, number, unit)] = {
+                'unit': unit, 'bus': 'sim%d' % number,
+                'measurement': 'inverter' if kind == 'inverters' else 'pzem',
+            }
+    return settings
+
+
+def decode_cost(count=10000):
+    # Microseconds to decode one sample from a register row
+    row = list(SimulatedGrowatt(1).input())
+    growatt_decode = timeit.timeit(lambda: [decoder.decode(row) for decoder in InputDecoders.values()], number=count)
+    row = list(SimulatedPzem(1).input())
+    pzem_decode = timeit.timeit(lambda: pzem.InputDecoder.decode(row), number=count)
+    return growatt_decode / count * 1e6, pzem_decode / count * 1e6
+
+
+def sink_throughput(sink, stub, count, timeout=60):
+    # Points per second through the sink until the stub has stored them all
+    fields = [decoder.decode(list(SimulatedGrowatt(1).input())) for decoder in InputDecoders.values()]
+    info = {key: value for values in fields for key, value in values.items()}
+    before = stub.points
+    started = time.perf_counter()
+    for i in range(count):
+        sink.put('throughput', {'time': i, 'measurement': 'throughput', 'fields': dict(info, Pac=float(i))})
+    queued = time.perf_counter() - started
+    while stub.points - before < count and time.perf_counter() - started < timeout:
+        time.sleep(0.01)
+    return count / queued, (stub.points - before) / (time.perf_counter() - started)
+
+
+def grid_publisher(client, meter, rate, stop):
+    # Tasmota style messages from a grid meter, for the MQTT pipeline
+    while not stop.is_set():
+        values = pzem.InputDecoder.decode(list(meter.input()))
+        client.publish(PzemTopic, json.dumps({
+            'Time': datetime.now().isoformat(timespec='seconds'),
+            'ENERGY': {'Voltage': round(values['Voltage']), 'Current': values['Current'],
+                       'Power': round(values['Power']), 'Factor': values['Factor'], 'Total': values['Total']},
+        }))
+        stop.wait(1 / rate)
+
+
+async def run_for(poller, seconds):
+    try:
+        await asyncio.wait_for(poller.run(), seconds)
+    except asyncio.TimeoutError:
+        pass
+
+
+def main(args):
+    stub = InfluxStub()
+    stub.start()
+    servers = start_buses(args)
+    settings = bench_settings(args, stub, servers)
+
+    buses = load_buses(settings)
+    for bus in buses.values():
+        bus.client = Timed(bus.client)
+    writer = InfluxWriter.from_settings(influxwriter.connect(settings), settings, 'bench')
+    output = Deadband.from_settings(writer, settings)
+
+    counter = Counter()
+    poller = Poller(args.interval, args.interval, args.interval)
+    poller.add_sink(counter)
+    poller.add_sink(output)
+    poller.add_sink(Rollup.from_settings(writer, settings))
+
+    for section in settings.sections():
+        kind, _, name = section.partition('.')
+        if kind not in ('inverters', 'meters'):
+            continue
+        bus = device_bus(buses, settings, section)
+        unit = settings.getint(section, 'unit')
+        reader = Growatt(bus.client, name, unit) if kind == 'inverters' else Pzem(bus.client, name, unit)
+        poller.add_device(Device(name, bus, reader, settings.get(section, 'measurement')))
+
+    stop = threading.Event()
+    if args.mode == 'mqtt':
+        # The grid meter path of solarmon-mqtt.py against the MQTT stand-in
+        mqttclient = MqttStub()
+        latest = LatestValues()
+        poller.add_sink(latest)
+        inverter = next(device.name for device in poller.devices if isinstance(device.reader, Growatt))
+        poller.add_sink(MqttSink(mqttclient, GrowattTopic, devices={inverter}))
+        grid = GridMeter.from_settings(settings, latest, inverter, args.interval)
+        grid.add_sink(output)
+
+        ingest = Ingest()
+        mqttclient.message_callback_add(PzemTopic, ingest.callback(grid.handle))
+        mqttclient.loop_start()
+        threading.Thread(target=grid_publisher, args=(mqttclient, SimulatedPzem(1), args.grid_rate, stop),
+                         daemon=True).start()
+
+    # Keep what the pipeline prints, eg. units that fail, out of the report
+    started = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        asyncio.run(run_for(poller, args.seconds))
+    elapsed = time.perf_counter() - started
+    stop.set()
+
+    latencies = [latency for bus in buses.values() for latency in bus.client.latencies]
+    samples = sum(counter.samples.values())
+    growatt_decode, pzem_decode = decode_cost()
+    queued, stored = sink_throughput(output, stub, args.points)
+    results = {
+        'polls': samples / elapsed,
+        'latency_p50': percentile(latencies, 50) * 1000,
+        'latency_p90': percentile(latencies, 90) * 1000,
+        'latency_p99': percentile(latencies, 99) * 1000,
+        'decode_growatt': growatt_decode,
+        'decode_pzem': pzem_decode,
+        'sink_queued': queued,
+        'sink_stored': stored,
+    }
+
+    print('%d inverters, %d meters on %d %s buses, %.1f s' % (
+        args.inverters, args.meters, args.buses, args.transport, elapsed))
+    print('polls:         %8.1f /s  (%d samples, %d overruns)' % (results['polls'], samples, poller.overruns))
+    print('transactions:  %8d      (%d errors)' % (len(latencies), sum(bus.client.errors for bus in buses.values())))
+    print('latency ms:    p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % (
+        results['latency_p50'], results['latency_p90'], results['latency_p99'], percentile(latencies, 100) * 1000))
+    print('decode us:     growatt %.1f  pzem %.1f' % (growatt_decode, pzem_decode))
+    if args.mode == 'mqtt':
+        print('mqtt:          %d published, %d received, %d failed' % (
+            mqttclient.published, ingest.received, ingest.failed))
+    print('sink:          %8.0f points/s queued, %.0f points/s stored' % (queued, stored))
+    print('influx:        %d requests, %d points, p99 write %.2f ms, %d dropped' % (
+        stub.requests, stub.points, percentile(stub.latencies, 99) * 1000, writer.dropped))
+    return results
+
+
+# Whether a higher value of each result is better
+Higher = {'polls': True, 'sink_queued': True, 'sink_stored': True}
+
+
+def compare(results, baseline, tolerance):
+    # Prints the change against a saved run, returns the results that got
+    # worse by more than tolerance percent
+    regressions = []
+    for key, value in results.items():
+        before = baseline.get(key)
+        if not before:
+            continue
+        change = (value - before) / before * 100
+        worse = -change if Higher.get(key) else change
+        flag = ''
+        if worse > tolerance:
+            regressions.append(key)
+            flag = '  REGRESSION'
+        print('%-16s %12.2f -> %12.2f  %+6.1f%%%s' % (key, before, value, change, flag))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='solarmon benchmark against simulated units')
+    parser.add_argument('--mode', choices=['solarmon', 'mqtt'], default='solarmon',
+                        help='pipeline of solarmon.py or solarmon-mqtt.py')
+    parser.add_argument('--transport', choices=['tcp', 'rtu-over-tcp', 'pty'], default='tcp')
+    parser.add_argument('--buses', type=int, default=1)
+    parser.add_argument('--inverters', type=int, default=1)
+    parser.add_argument('--meters', type=int, default=0)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=0.01,
+                        help='poll interval, small values poll as fast as the units answer')
+    parser.add_argument('--delay', type=float, default=0, help='seconds each unit takes to answer')
+    parser.add_argument('--baudrate', type=int, default=0, help='simulated line speed of pty buses')
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--points', type=int, default=50000, help='points for the sink throughput test')
+    parser.add_argument('--grid-rate', type=float, default=10, help='grid meter messages per second')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=20, help='percent a result may get worse')
+    args = parser.parse_args()
+
+    results = main(args)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -0,0 +1,221 @@
+import json
+import os
+import struct
+import threading
+import time
+
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+from pymodbus.register_read_message import ReadHoldingRegistersResponse, ReadInputRegistersResponse
+
+# A capture is Magic followed by records, each a Header of kind, time,
+# device id and a count:
+#   DeviceRecord: count bytes of JSON naming the device, kind, unit and
+#                 measurement behind the id
+#   PollRecord:   count blocks read by one poll of the device, each a Block
+#                 of function, address and register count followed by the
+#                 registers, all little endian
+Magic = b'SOLARCAP\x01'
+Header = struct.Struct('<BdHH')
+Block = struct.Struct('<BHH')
+DeviceRecord = 0
+PollRecord = 1
+
+Responses = {3: ReadHoldingRegistersResponse, 4: ReadInputRegistersResponse}
+
+
+def add_arguments(parser):
+    parser.add_argument('--capture', metavar='FILE',
+                        help='append the raw register blocks of every poll to FILE, see replay.py')
+
+
+class Capture:
+    # Appends the register blocks every poll read to a capture file. Blocks
+    # are collected per thread, a poll runs on its bus thread from start to
+    # end, and written as one record when the poll is done.
+
+    def __init__(self, path, flush_interval=5):
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        if not new:
+            # A record cut short by a crash would run into the ones appended
+            # after it, cut the file back to the last complete record
+            end = complete(path)
+            if end < os.path.getsize(path):
+                print('Dropping %d bytes of an incomplete record from %s' % (os.path.getsize(path) - end, path))
+                os.truncate(path, end)
+        self.file = open(path, 'ab')
+        if new:
+            self.file.write(Magic)
+        self.flush_interval = flush_interval
+        self.flushed = time.monotonic()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.devices = 0
+
+    @classmethod
+    def from_args(cls, args):
+        # Returns None without --capture
+        if not args.capture:
+            return None
+        return cls(args.capture)
+
+    def client(self, client):
+        return CaptureClient(client, self)
+
+    def reader(self, reader, name, kind, unit, measurement):
+        # Declares the device in the capture and wraps its reader
+        data = json.dumps({'name': name, 'kind': kind, 'unit': unit, 'measurement': measurement}).encode()
+        with self.lock:
+            device = self.devices
+            self.devices += 1
+            self.file.write(Header.pack(DeviceRecord, time.time(), device, len(data)) + data)
+        return CapturedReader(reader, self, device)
+
+    def add(self, function, address, registers):
+        blocks = getattr(self.local, 'blocks', None)
+        if blocks is not None:
+            blocks.append(Block.pack(function, address, len(registers)) +
+                          struct.pack('<%dH' % len(registers), *registers))
+
+    def begin(self):
+        self.local.blocks = []
+
+    def end(self, device, now):
+        blocks, self.local.blocks = self.local.blocks, None
+        if not blocks:
+            return
+        with self.lock:
+            self.file.write(Header.pack(PollRecord, now, device, len(blocks)) + b''.join(blocks))
+            if time.monotonic() - self.flushed >= self.flush_interval:
+                self.file.flush()
+                self.flushed = time.monotonic()
+
+
+class CaptureClient:
+    # Wraps the client of one device, handing every register block it
+    # reads to the capture
+    def __init__(self, client, capture):
+        self.client = client
+        self.capture = capture
+
+    def read_input_registers(self, address, count=1, unit=1):
+        response = self.client.read_input_registers(address, count, unit=unit)
+        if not response.isError():
+            self.capture.add(4, address, response.registers)
+        return response
+
+    def read_holding_registers(self, address, count=1, unit=1):
+        response = self.client.read_holding_registers(address, count, unit=unit)
+        if not response.isError():
+            self.capture.add(3, address, response.registers)
+        return response
+
+
+class CapturedReader:
+    def __init__(self, reader, capture, device):
+        self.reader = reader
+        self.capture = capture
+        self.device = device
+
+    def read(self):
+        now = time.time()
+        self.capture.begin()
+        try:
+            return self.reader.read()
+        finally:
+            self.capture.end(self.device, now)
+
+
+def read_records(f):
+    # Yields (kind, time, device, value, end) for every complete record
+    # after the magic, end being the file offset just past the record
+    while True:
+        header = f.read(Header.size)
+        if len(header) < Header.size:
+            return
+        kind, moment, device, count = Header.unpack(header)
+        if kind == DeviceRecord:
+            data = f.read(count)
+            if len(data) < count:
+                return
+            try:
+                value = json.loads(data)
+            except ValueError:
+                return
+            yield kind, moment, device, value, f.tell()
+            continue
+        if kind != PollRecord:
+            return
+
+        blocks = []
+        for _ in range(count):
+            data = f.read(Block.size)
+            if len(data) < Block.size:
+                return
+            function, address, size = Block.unpack(data)
+            data = f.read(size * 2)
+            if len(data) < size * 2 or function not in Responses:
+                return
+            blocks.append((function, address, struct.unpack('<%dH' % size, data)))
+        yield kind, moment, device, blocks, f.tell()
+
+
+def complete(path):
+    # Length of the capture up to the end of its last complete record
+    with open(path, 'rb') as f:
+        if f.read(len(Magic)) != Magic:
+            raise ValueError('%s is not a capture' % path)
+        end = len(Magic)
+        for record in read_records(f):
+            end = record[-1]
+        return end
+
+
+def records(path):
+    # Yields (kind, time, device, value) for every record of a capture,
+    # value is the device dict or [(function, address, registers)]. A
+    # record cut short at the end, by a crash while capturing, is skipped.
+    with open(path, 'rb') as f:
+        if f.read(len(Magic)) != Magic:
+            raise ValueError('%s is not a capture' % path)
+        for kind, moment, device, value, _ in read_records(f):
+            yield kind, moment, device, value
+
+
+class ReplayClient:
+    # Answers reads from the registers captured so far, like the unit did
+    # when they were captured. Registers it never answered for are
+    # rejected as illegal addresses, so read plans narrow down the same way
+    # they did live, and registers the current poll did not read are a
+    # unit that did not answer.
+    def __init__(self):
+        self.registers = {3: {}, 4: {}}
+        self.current = {3: set(), 4: set()}
+
+    def poll(self, blocks):
+        # Loads the blocks of the next captured poll
+        self.current = {3: set(), 4: set()}
+        for function, address, registers in blocks:
+            self.load(function, address, registers)
+
+    def load(self, function, address, registers):
+        table = self.registers[function]
+        current = self.current[function]
+        for offset, value in enumerate(registers):
+            table[address + offset] = value
+            current.add(address + offset)
+
+    def read(self, function, address, count):
+        table = self.registers[function]
+        wanted = range(address, address + count)
+        if any(register not in table for register in wanted):
+            return ExceptionResponse(function, ModbusExceptions.IllegalAddress)
+        if any(register not in self.current[function] for register in wanted):
+            return ModbusIOException('Registers %d-%d were not captured' % (address, address + count - 1))
+        return Responses[function]([table[register] for register in wanted])
+
+    def read_input_registers(self, address, count=1, unit=1):
+        return self.read(4, address, count)
+
+    def read_holding_registers(self, address, count=1, unit=1):
+        return self.read(3, address, count)
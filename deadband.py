@@ -0,0 +1,74 @@
+import time
+
+
+def parse_band(value):
+    # '5' is an absolute deadband, '2%' a relative one
+    value = value.strip()
+    if value.endswith('%'):
+        return float(value[:-1]) / 100, True
+    return float(value), False
+
+
+class Deadband:
+    # Passes on only the fields that moved beyond their deadband since they
+    # were last sent, and a full keyframe every heartbeat seconds. Fields
+    # without a deadband are sent whenever their value changes.
+
+    def __init__(self, sink=None, bands=None, heartbeat=60):
+        self.sink = sink
+        self.heartbeat = heartbeat
+        # Option names from solarmon.cfg are lower case, fields are not
+        self.bands = {name.lower(): band for name, band in (bands or {}).items()}
+        self.fields = {}
+        self.sent = {}
+        self.keyframes = {}
+        self.suppressed = 0
+
+    @classmethod
+    def from_settings(cls, sink, settings):
+        # Returns the sink itself when the [deadband] section is missing
+        if not settings.has_section('deadband'):
+            return sink
+        bands = {name: parse_band(value) for name, value in settings.items('deadband') if name != 'heartbeat'}
+        return cls(sink, bands, settings.getfloat('deadband', 'heartbeat', fallback=60))
+
+    def band(self, field):
+        if field not in self.fields:
+            self.fields[field] = self.bands.get(field.lower(), (0, False))
+        return self.fields[field]
+
+    def moved(self, field, value, last):
+        if type(value) is str or type(last) is str:
+            return value != last
+        band, relative = self.band(field)
+        if relative:
+            band *= abs(last)
+        return abs(value - last) > band
+
+    def filter(self, name, point):
+        # Returns the point to send, or None if nothing moved
+        now = point.get('time', time.time())
+        fields = point['fields']
+        sent = self.sent.get(name)
+
+        if sent is None or now - self.keyframes[name] >= self.heartbeat:
+            self.sent[name] = dict(fields)
+            self.keyframes[name] = now
+            return point
+
+        changed = {}
+        for field, value in fields.items():
+            last = sent.get(field)
+            if last is None or value is None or self.moved(field, value, last):
+                changed[field] = value
+                sent[field] = value
+
+        self.suppressed += len(fields) - len(changed)
+        if not changed:
+            return None
+        return dict(point, fields=changed)
+
+    def put(self, name, point):
+        point = self.filter(name, point)
+        if point is not None:
+            self.sink.put(name, point)
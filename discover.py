@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+# Sweeps the unit ids of every configured bus for Growatt inverters and
+# PZEM-004T meters. Units found by the last scan, or configured, are
+# probed first. Found units are added to the identity cache, and with
+# --write their [inverters.*] and [meters.*] sections are appended to
+# solarmon.cfg.
+#
+#   python3 discover.py --timeout 0.05
+#   python3 discover.py --units 1-10 --write
+#   python3 discover.py --expect 3
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from configparser import RawConfigParser
+
+from growatt import Growatt
+from identity import IdentityCache
+from transport import load_buses
+
+Kinds = {'growatt': 'inverters', 'pzem': 'meters'}
+Measurements = {'growatt': 'inverter', 'pzem': 'pzem'}
+
+
+def parse_units(value):
+    # '1-10,20' -> [1, ..., 10, 20]
+    units = []
+    for part in value.split(','):
+        first, _, last = part.strip().partition('-')
+        units.extend(range(int(first), int(last or first) + 1))
+    return units
+
+
+def scan_settings(settings, timeout):
+    # The same buses with a short fixed timeout, a missing unit then costs
+    # timeout seconds instead of the polling timeout
+    scan = RawConfigParser()
+    scan.read_dict(settings)
+    for section in scan.sections():
+        if section.startswith('bus.') or section == 'solarmon':
+            scan.set(section, 'timeout', str(timeout))
+            scan.set(section, 'adaptive', 'false')
+    return scan
+
+
+def configured(settings, buses):
+    # {(bus, unit): section} of the units already in the config
+    first = next(iter(buses))
+    units = {}
+    for section in settings.sections():
+        kind, _, _ = section.partition('.')
+        if kind in Kinds.values():
+            units[(settings.get(section, 'bus', fallback=first), settings.getint(section, 'unit'))] = section
+    return units
+
+
+def probe(client, unit):
+    # 'growatt', 'pzem' or None. Both answer input registers 0-9, only a
+    # Growatt has the Modbus version at holding register 73 and a PZEM
+    # holds its own address at holding register 2.
+    if client.read_input_registers(0, 10, unit=unit).isError():
+        return None
+    if not client.read_holding_registers(73, 1, unit=unit).isError():
+        return 'growatt'
+    row = client.read_holding_registers(2, 1, unit=unit)
+    if not row.isError() and row.registers[0] == unit:
+        return 'pzem'
+    return None
+
+
+def identify(client, name, unit, kind):
+    if kind != 'growatt':
+        return None
+    try:
+        return Growatt(client, name, unit).identity
+    except Exception as err:
+        print('%s: failed to read the identity' % name)
+        print(err)
+        return None
+
+
+def scan_bus(bus, units, known, expect=None):
+    # [(unit, kind, identity)] of the units answering on one bus, those in
+    # known probed first. Stops once expect units were found.
+    order = [unit for unit in units if unit in known] + [unit for unit in units if unit not in known]
+    found = []
+
+    def check(unit):
+        if expect and len(found) >= expect:
+            return
+        kind = probe(bus.client, unit)
+        if kind is not None:
+            identity = identify(bus.client, '%s_%d' % (bus.name, unit), unit, kind)
+            print('%s unit %d: %s %s' % (bus.name, unit, kind, identity or ''))
+            found.append((unit, kind, identity))
+
+    # Gateways with several connections are probed that many units at once
+    with ThreadPoolExecutor(max_workers=getattr(bus.client, 'size', 1)) as executor:
+        list(executor.map(check, order))
+    return sorted(found)
+
+
+def sections(bus, default, results, existing):
+    # Config text for the units not configured yet
+    lines = []
+    for unit, kind, identity in results:
+        if (bus, unit) in existing:
+            continue
+        name = '%s_%d' % (bus, unit)
+        lines += ['', '[%s.%s]' % (Kinds[kind], name), 'unit = %d' % unit,
+                  'measurement = %s_%s' % (Measurements[kind], name)]
+        if bus != default:
+            lines.append('bus = %s' % bus)
+    return lines
+
+
+def main(args):
+    path = os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg'
+    settings = RawConfigParser()
+    settings.read(path)
+    buses = load_buses(scan_settings(settings, args.timeout))
+    existing = configured(settings, buses)
+    identities = IdentityCache.from_settings(settings)
+    units = parse_units(args.units)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(buses)) as executor:
+        scans = {}
+        for name, bus in buses.items():
+            known = {unit for bus_name, unit in existing if bus_name == name}
+            if identities is not None:
+                known |= {int(key.rpartition(':')[2]) for key in identities.units
+                          if key.rpartition(':')[0] == name}
+            scans[name] = executor.submit(scan_bus, bus, units, known, args.expect)
+        results = {name: scan.result() for name, scan in scans.items()}
+    print('Scanned %d units on %d buses in %.1f s' % (len(units), len(buses), time.monotonic() - started))
+
+    lines = []
+    default = next(iter(buses))
+    for name, found in results.items():
+        if identities is not None:
+            for unit, kind, identity in found:
+                identities.put(name, unit, kind, identity)
+        lines += sections(name, default, found, existing)
+
+    if not lines:
+        print('No new units')
+    elif args.write:
+        with open(path, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        print('Added %d units to %s' % (sum(line.startswith('[') for line in lines), path))
+    else:
+        print('\n'.join(lines))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='find Growatt inverters and PZEM-004T meters on every bus')
+    parser.add_argument('--units', default='1-247', help='unit ids to probe, eg. 1-10,20')
+    parser.add_argument('--timeout', type=float, default=0.1, help='seconds to wait for each unit')
+    parser.add_argument('--expect', type=int, help='stop scanning a bus once this many units answered')
+    parser.add_argument('--write', action='store_true', help='append the new units to solarmon.cfg')
+    main(parser.parse_args())
@@ -0,0 +1,119 @@
+import os
+import sqlite3
+import threading
+
+from poller import Backoff
+
+
+class FaultIndex:
+    # Every fault record seen, in SQLite keyed by device, unit, time and
+    # code, so a restart does not report the whole table again
+
+    def __init__(self, path=':memory:'):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS faults ('
+                            'device TEXT, unit INTEGER, time INTEGER, code INTEGER, value INTEGER, '
+                            'PRIMARY KEY (device, unit, time, code)) WITHOUT ROWID')
+
+    def add(self, device, unit, records):
+        # Stores the records, returns the ones not seen before oldest first.
+        # Records without a valid time are keyed on time 0.
+        new = []
+        with self.lock, self.db:
+            for record in sorted(records, key=lambda record: record['Time'] or 0):
+                cursor = self.db.execute('INSERT OR IGNORE INTO faults VALUES (?, ?, ?, ?, ?)',
+                                         (device, unit, record['Time'] or 0, record['FaultCode'], record['Value']))
+                if cursor.rowcount:
+                    new.append(record)
+        return new
+
+    def history(self, device, since=0):
+        # [(time, code, value)] of a device from since on
+        with self.lock:
+            return self.db.execute('SELECT time, code, value FROM faults WHERE device = ? AND time >= ? '
+                                   'ORDER BY time', (device, since)).fetchall()
+
+
+class FaultHistory:
+    # Reads the fault table of an inverter once at start, again whenever the
+    # fault code in its samples changes and every interval seconds in case a
+    # fault came and went between two polls. Faults not in the index are
+    # sent to the sinks as events, timed when the inverter recorded them.
+    # Runs on the thread of the inverter's bus, between its polls. A failed
+    # read is retried after retry seconds, doubling up to interval, so a
+    # unit that does not answer it costs a bus timeout that often at most.
+
+    def __init__(self, index, measurement='faults', interval=3600, retry=60):
+        self.index = index
+        self.sinks = []
+        self.measurement = measurement
+        self.interval = interval
+        # Per device: fault code of the last read and when the next is due
+        self.codes = {}
+        self.due = {}
+        # Devices whose model has no fault table
+        self.missing = set()
+        # Per device: Backoff and time of the next try after failed reads
+        self.retry = retry
+        self.failures = {}
+        self.retry_at = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Returns None when the [faults] section is missing
+        if not settings.has_section('faults'):
+            return None
+        path = settings.get('faults', 'index', fallback=None) or \
+            os.path.join(os.path.dirname(os.path.realpath(__file__)), 'faults.db')
+        return cls(FaultIndex(path),
+                   settings.get('faults', 'measurement', fallback='faults'),
+                   settings.getfloat('faults', 'interval', fallback=3600))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def check(self, reader, info, now):
+        name = reader.name
+        code = info.get('FaultCode')
+        if name in self.missing or now < self.retry_at.get(name, 0):
+            return
+        if name in self.codes and code == self.codes[name] and now < self.due[name]:
+            return
+
+        try:
+            records = reader.read_fault_table()
+        except Exception as err:
+            backoff = self.failures.setdefault(name, Backoff(self.retry, self.interval or self.retry))
+            self.retry_at[name] = now + backoff.next()
+            print('Failed to read the fault history of %s, retrying in %d s' % (name, backoff.delay))
+            print(err)
+            return
+        self.failures.pop(name, None)
+
+        self.codes[name] = code
+        if records is None:
+            print('%s has no fault history' % name)
+            self.missing.add(name)
+            return
+        self.due[name] = now + self.interval if self.interval else float('inf')
+
+        for record in self.index.add(name, reader.unit, records):
+            self.emit(name, reader.unit, record, now)
+
+    def emit(self, name, unit, record, now):
+        point = {
+            'time': record['Time'] or int(now),
+            'measurement': self.measurement,
+            'fields': {
+                'Inverter': name,
+                'Unit': unit,
+                'FaultCode': record['FaultCode'],
+                'Fault': record['Fault'],
+                'Value': record['Value'],
+            }
+        }
+        print('%s fault: %s (%d), value %d' % (name, record['Fault'], record['FaultCode'], record['Value']))
+        for sink in self.sinks:
+            sink.put(name, point)
@@ -0,0 +1,54 @@
+import time
+
+from payload import Schema, TasmotaEnergy
+from rollingstats import GridMetrics
+
+
+class GridMeter:
+    # The grid meter messages of solarmon-mqtt.py. Each is joined with the
+    # latest sample of one inverter, only an in-memory lookup as the
+    # inverters are polled on their own schedule, extended with the
+    # GridMetrics fields and handed to the sinks as a point.
+
+    def __init__(self, latest, inverter, measurement='grid', max_age=5, window=5, truncate=False, debug=False):
+        self.latest = latest
+        self.inverter = inverter
+        self.measurement = measurement
+        self.max_age = max_age
+        self.debug = debug
+        self.schema = Schema(TasmotaEnergy, truncate=truncate)
+        # Power direction and rolling voltage difference statistics over
+        # the last window grid samples
+        self.metrics = GridMetrics(window)
+        self.sinks = []
+
+    @classmethod
+    def from_settings(cls, settings, latest, inverter, interval):
+        return cls(latest, inverter,
+                   settings.get('mqtt', 'measurement', fallback='grid'),
+                   settings.getfloat('mqtt', 'max_age', fallback=5 * interval),
+                   settings.getint('mqtt', 'vdiff_window', fallback=5),
+                   # Existing databases hold the fractional values as integers
+                   not settings.getboolean('mqtt', 'float_fields', fallback=False),
+                   settings.getboolean('query', 'debug', fallback=False))
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def handle(self, payload):
+        # Ingest handler for the subscribe-pzem topic
+        now = time.time()
+        growattinfo = self.latest.get(self.inverter, self.max_age)
+
+        if self.debug:
+            print("message received ", payload)
+        energy_parsed = self.schema.parse_fields(payload)
+        energy_parsed.update(self.metrics.update(energy_parsed, growattinfo))
+
+        point = {
+            'time': int(now),
+            'measurement': self.measurement,
+            "fields": energy_parsed
+        }
+        for sink in self.sinks:
+            sink.put(self.measurement, point)
@@ -1,5 +1,10 @@
 import datetime
+import time
 from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+
+from readplan import ReadPlan
+from registers import Field, RegisterDecoder
 
 # Codes
 StateCodes = {
@@ -37,192 +42,245 @@ DeratingMode = {
     9: '*OverBackByTime',
 }
 
-def read_single(row, index, unit=10):
-    return float(row.registers[index]) / unit
+# Input registers
+# http://www.growatt.pl/dokumenty/Inne/Growatt%20PV%20Inverter%20Modbus%20RS485%20RTU%20Protocol%20V3.04.pdf
+InputRegisters = [
+    #     Name,          Address, Width, Scale, Unit,    Codes                      # Variable Name,    Description
+    Field('StatusCode',    0,     1,     None,  'N/A',   ('Status', StateCodes)),   # Inverter Status,  Inverter run state
+    Field('Ppv',           1,     2,     10,    'W'),                               # Ppv H/L,          Input power
+    Field('Vpv1',          3,     1,     10,    'V'),                               # Vpv1,             PV1 voltage
+    Field('PV1Curr',       4,     1,     10,    'A'),                               # PV1Curr,          PV1 input current
+    Field('PV1Watt',       5,     2,     10,    'W'),                               # PV1Watt H/L,      PV1 input watt
+    Field('Vpv2',          7,     1,     10,    'V'),                               # Vpv2,             PV2 voltage
+    Field('PV2Curr',       8,     1,     10,    'A'),                               # PV2Curr,          PV2 input current
+    Field('PV2Watt',       9,     2,     10,    'W'),                               # PV2Watt H/L,      PV2 input watt
+    Field('Pac',          11,     2,     10,    'W'),                               # Pac H/L,          Output power
+    Field('Fac',          13,     1,     100,   'Hz'),                              # Fac,              Grid frequency
+    Field('Vac1',         14,     1,     10,    'V'),                               # Vac1,             Three/single phase grid voltage
+    Field('Iac1',         15,     1,     10,    'A'),                               # Iac1,             Three/single phase grid output current
+    Field('Pac1',         16,     2,     10,    'VA'),                              # Pac1 H/L,         Three/single phase grid output watt
+    Field('Vac2',         18,     1,     10,    'V'),                               # Vac2,             Three phase grid voltage
+    Field('Iac2',         19,     1,     10,    'A'),                               # Iac2,             Three phase grid output current
+    Field('Pac2',         20,     2,     10,    'VA'),                              # Pac2 H/L,         Three phase grid output power
+    Field('Vac3',         22,     1,     10,    'V'),                               # Vac3,             Three phase grid voltage
+    Field('Iac3',         23,     1,     10,    'A'),                               # Iac3,             Three phase grid output current
+    Field('Pac3',         24,     2,     10,    'VA'),                              # Pac3 H/L,         Three phase grid output power
+    Field('EnergyToday',  26,     2,     10,    'kWh'),                             # Energy today H/L, Today generate energy
+    Field('EnergyTotal',  28,     2,     10,    'kWh'),                             # Energy total H/L, Total generate energy
+    Field('TimeTotal',    30,     2,     2,     's'),                               # Time total H/L,   Work time total
+    Field('Temp',         32,     1,     10,    'C'),                               # Temperature,      Inverter temperature
+    Field('ISOFault',     33,     1,     10,    'V'),                               # ISO fault Value,  ISO Fault value
+    Field('GFCIFault',    34,     1,     1,     'mA'),                              # GFCI fault Value, GFCI fault Value
+    Field('DCIFault',     35,     1,     100,   'A'),                               # DCI fault Value,  DCI fault Value
+    Field('VpvFault',     36,     1,     10,    'V'),                               # Vpv fault Value,  PV voltage fault value
+    Field('VavFault',     37,     1,     10,    'V'),                               # Vac fault Value,  AC voltage fault value
+    Field('FacFault',     38,     1,     100,   'Hz'),                              # Fac fault Value,  AC frequency fault value
+    Field('TempFault',    39,     1,     10,    'C'),                               # Temp fault Value, Temperature fault value
+    Field('FaultCode',    40,     1,     None,  'N/A',   ('Fault', ErrorCodes)),    # Fault code,       Inverter fault bit
+    Field('IPMTemp',      41,     1,     10,    'C'),                               # IPM Temperature,  The inside IPM in inverter Temperature
+    Field('PBusV',        42,     1,     10,    'V'),                               # P Bus Voltage,    P Bus inside Voltage
+    Field('NBusV',        43,     1,     10,    'V'),                               # N Bus Voltage,    N Bus inside Voltage
+    #                     44                                                        # Check Step,       Product check step
+    #                     45                                                        # IPF,              Inverter output PF now
+    #                     46                                                        # ResetCHK,         Reset check data
+    Field('DeratingMode', 47,     1,     None,  'N/A',   ('Derating', DeratingMode)),  # DeratingMode,  DeratingMode
+    Field('Epv1_today',   48,     2,     10,    'kWh'),                             # Epv1_today H/L,   PV Energy today
+    Field('Epv1_total',   50,     2,     10,    'kWh'),                             # Epv1_total H/L,   PV Energy total
+    Field('Epv2_today',   52,     2,     10,    'kWh'),                             # Epv2_today H/L,   PV Energy today
+    Field('Epv2_total',   54,     2,     10,    'kWh'),                             # Epv2_total H/L,   PV Energy total
+    Field('Epv_total',    56,     2,     10,    'kWh'),                             # Epv_total H/L,    PV Energy total
+    Field('Rac',          58,     2,     10,    'Var'),                             # Rac H/L,          AC Reactive power
+    Field('E_rac_today',  60,     2,     10,    'kVarh'),                           # E_rac_today H/L,  AC Reactive energy
+    Field('E_rac_total',  62,     2,     10,    'kVarh'),                           # E_rac_total H/L,  AC Reactive energy
+    Field('WarningCode',  64,     1,     None,  'N/A'),                             # WarningCode,      Warning Code
+    Field('WarningValue', 65,     1,     None,  'N/A'),                             # WarningValue,     Warning Value
+]
+
+def text(registers):
+    return b''.join(register.to_bytes(2, 'big') for register in registers).decode('ascii', 'replace').strip('\x00 ')
+
+
+def hexadecimal(registers):
+    return ''.join('%04X' % register for register in registers)
+
+
+# Holding registers identifying the unit, name: (address, width, decode)
+IdentityRegisters = {
+    'Firmware':        (9,  3, text),         # Firmware version H/M/L
+    'ControlFirmware': (12, 3, text),         # Control firmware version H/M/L
+    'Serial':          (23, 5, text),         # Serial NO
+    'Model':           (28, 2, hexadecimal),  # Inverter Module H/L
+}
+IdentityStart = min(address for address, _, _ in IdentityRegisters.values())
+IdentityCount = max(address + width for address, width, _ in IdentityRegisters.values()) - IdentityStart
+
+# Fault history, FaultRecords records of FaultRecordWidth input registers
+# from FaultTable. Each holds the fault code, the time packed a byte per
+# part as year since 2000 and month, day and hour, minute and second, in
+# the inverter's local time, and the fault value. Unused records are zero.
+FaultTable = 90
+FaultRecords = 5
+FaultRecordWidth = 5
+
+
+def fault_time(registers):
+    # Unix time of a fault record, None when the time is not a valid date
+    try:
+        return int(datetime.datetime(2000 + (registers[1] >> 8), registers[1] & 0xFF,
+                                     registers[2] >> 8, registers[2] & 0xFF,
+                                     registers[3] >> 8, registers[3] & 0xFF).timestamp())
+    except ValueError:
+        return None
+
+
+def decode_fault_record(registers):
+    code = registers[0]
+    if code == 0:
+        return None
+    return {
+        'FaultCode': code,
+        'Fault': ErrorCodes.get(code, 'Unknown: %d' % code),
+        'Time': fault_time(registers),
+        'Value': registers[4],
+    }
+
+# Register groups that change slowly and can be polled at their own rate,
+# see [rates] in solarmon.cfg. Every other field is in the 'power' group and
+# is read on every poll.
+InputGroups = {
+    'energy': ['EnergyToday', 'EnergyTotal', 'TimeTotal',
+               'Epv1_today', 'Epv1_total', 'Epv2_today', 'Epv2_total', 'Epv_total',
+               'E_rac_today', 'E_rac_total'],
+    'fault': ['ISOFault', 'GFCIFault', 'DCIFault', 'VpvFault', 'VavFault', 'FacFault', 'TempFault'],
+}
 
-def read_double(row, index, unit=10):
-    return float((row.registers[index] << 16) + row.registers[index + 1]) / unit
+def compile_groups(fields, groups, default='power'):
+    grouped = {name: group for group, names in groups.items() for name in names}
+    decoders = {}
+    for group in [default] + list(groups):
+        decoders[group] = RegisterDecoder([field for field in fields if grouped.get(field.name, default) == group])
+    return decoders
 
-def merge(*dict_args):
-    result = {}
-    for dictionary in dict_args:
-        result.update(dictionary)
-    return result
+# Compiled once, shared by every inverter
+InputDecoders = compile_groups(InputRegisters, InputGroups)
 
 class Growatt:
-    def __init__(self, client, name, unit):
+    def __init__(self, client, name, unit, rates=None, faults=None, identity=None):
         self.client = client
         self.name = name
         self.unit = unit
+        # FaultHistory reading the fault table when the fault code changes
+        self.faults = faults
+
+        # Seconds between reads of each register group, groups without a
+        # rate are read on every poll
+        self.rates = rates or {}
+        self.due = dict.fromkeys(InputDecoders, 0)
+        self.last = {}
+        # One read plan per combination of due groups, all sharing what we
+        # learn about the ranges this unit refuses to have bridged
+        self.plans = {}
+        self.barriers = set()
+        # Ranges of fields this model does not have, and the decoders
+        # without them
+        self.unsupported = set()
+        self.decoders = InputDecoders
 
-        self.read_info()
+        # A cached identity saves reading it from the unit at startup
+        if identity is None:
+            self.read_info()
+        else:
+            self.set_identity(identity)
 
     def read_info(self):
+        self.set_identity(self.read_identity())
+
+    def set_identity(self, identity):
+        self.identity = identity
+        self.modbusVersion = identity['ModbusVersion']
+
+    def read_identity(self):
         row = self.client.read_holding_registers(73, unit=self.unit)
-        if type(row) is ModbusIOException:
-            raise row
+        if row.isError():
+            raise row if isinstance(row, ModbusIOException) else ModbusIOException(str(row))
+        identity = {'ModbusVersion': row.registers[0]}
 
-        self.modbusVersion = row.registers[0]
+        # Older models may not have these, they are only informational
+        row = self.client.read_holding_registers(IdentityStart, IdentityCount, unit=self.unit)
+        if not row.isError():
+            for name, (address, width, decode) in IdentityRegisters.items():
+                offset = address - IdentityStart
+                identity[name] = decode(row.registers[offset:offset + width])
+        return identity
 
     def print_info(self):
         print('Growatt:')
         print('\tName: ' + str(self.name))
         print('\tUnit: ' + str(self.unit))
         print('\tModbus Version: ' + str(self.modbusVersion))
+        for name in IdentityRegisters:
+            if name in self.identity:
+                print('\t%s: %s' % (name, self.identity[name]))
+
+    def plan(self, groups):
+        if groups not in self.plans:
+            ranges = [r for group in groups for r in self.decoders[group].ranges()]
+            self.plans[groups] = ReadPlan(ranges, barriers=self.barriers, unsupported=self.unsupported)
+        return self.plans[groups]
+
+    def read(self, now=None):
+        if now is None:
+            now = time.time()
 
-    def read(self):
-        row = self.client.read_input_registers(0, 33, unit=self.unit)
-        if type(row) is ModbusIOException:
+        # Every due group is fetched in as few transactions as the unit
+        # allows and decoded in one pass
+        groups = frozenset(group for group, due in self.due.items() if due <= now)
+        known = len(self.unsupported)
+        row = self.plan(groups).read(self.client, self.unit)
+        if row is None:
+            # Start from a full read when the unit comes back
+            self.due = dict.fromkeys(self.due, 0)
+            self.last = {}
             return None
+        if len(self.unsupported) != known:
+            self.drop_unsupported()
 
-        # http://www.growatt.pl/dokumenty/Inne/Growatt%20PV%20Inverter%20Modbus%20RS485%20RTU%20Protocol%20V3.04.pdf
-        #                                           # Unit,     Variable Name,      Description
-        info = {                                    # ==================================================================
-            'StatusCode': row.registers[0],         # N/A,      Inverter Status,    Inverter run state
-            'Status': StateCodes[row.registers[0]],
-            'Ppv': read_double(row, 1),             # 0.1W,     Ppv H,              Input power (high)
-                                                    # 0.1W,     Ppv L,              Input power (low)
-            'Vpv1': read_single(row, 3),            # 0.1V,     Vpv1,               PV1 voltage
-            'PV1Curr': read_single(row, 4),         # 0.1A,     PV1Curr,            PV1 input current
-            'PV1Watt': read_double(row, 5),         # 0.1W,     PV1Watt H,          PV1 input watt (high)
-                                                    # 0.1W,     PV1Watt L,          PV1 input watt (low)
-            'Vpv2': read_single(row, 7),            # 0.1V,     Vpv2,               PV2 voltage
-            'PV2Curr': read_single(row, 8),         # 0.1A,     PV2Curr,            PV2 input current
-            'PV2Watt': read_double(row, 9),         # 0.1W,     PV2Watt H,          PV2 input watt (high)
-                                                    # 0.1W,     PV2Watt L,          PV2 input watt (low)
-            'Pac': read_double(row, 11),            # 0.1W,     Pac H,              Output power (high)
-                                                    # 0.1W,     Pac L,              Output power (low)
-            'Fac': read_single(row, 13, 100),       # 0.01Hz,   Fac,                Grid frequency
-            'Vac1': read_single(row, 14),           # 0.1V,     Vac1,               Three/single phase grid voltage
-            'Iac1': read_single(row, 15),           # 0.1A,     Iac1,               Three/single phase grid output current
-            'Pac1': read_double(row, 16),           # 0.1VA,    Pac1 H,             Three/single phase grid output watt (high)
-                                                    # 0.1VA,    Pac1 L,             Three/single phase grid output watt (low)
-            'Vac2': read_single(row, 18),           # 0.1V,     Vac2,               Three phase grid voltage
-            'Iac2': read_single(row, 19),           # 0.1A,     Iac2,               Three phase grid output current
-            'Pac2': read_double(row, 20),           # 0.1VA,    Pac2 H,             Three phase grid output power (high)
-                                                    # 0.1VA,    Pac2 L,             Three phase grid output power (low)
-            'Vac3': read_single(row, 22),           # 0.1V,     Vac3,               Three phase grid voltage
-            'Iac3': read_single(row, 23),           # 0.1A,     Iac3,               Three phase grid output current
-            'Pac3': read_double(row, 24),           # 0.1VA,    Pac3 H,             Three phase grid output power (high)
-                                                    # 0.1VA,    Pac3 L,             Three phase grid output power (low)
-            'EnergyToday': read_double(row, 26),    # 0.1kWh,   Energy today H,     Today generate energy (high)
-                                                    # 0.1kWh,   Energy today L,     Today generate energy today (low)
-            'EnergyTotal': read_double(row, 28),    # 0.1kWh,   Energy total H,     Total generate energy (high)
-                                                    # 0.1kWh,   Energy total L,     Total generate energy (low)
-            'TimeTotal': read_double(row, 30, 2),   # 0.5S,     Time total H,       Work time total (high)
-                                                    # 0.5S,     Time total L,       Work time total (low)
-            'Temp': read_single(row, 32)            # 0.1C,     Temperature,        Inverter temperature
-        }
-
-        row = self.client.read_input_registers(33, 8, unit=self.unit)
-        info = merge(info, {
-            'ISOFault': read_single(row, 0),        # 0.1V,     ISO fault Value,    ISO Fault value
-            'GFCIFault': read_single(row, 1, 1),    # 1mA,      GFCI fault Value,   GFCI fault Value
-            'DCIFault': read_single(row, 2, 100),   # 0.01A,    DCI fault Value,    DCI fault Value
-            'VpvFault': read_single(row, 3),        # 0.1V,     Vpv fault Value,    PV voltage fault value
-            'VavFault': read_single(row, 4),        # 0.1V,     Vac fault Value,    AC voltage fault value
-            'FacFault': read_single(row, 5, 100),   # 0.01 Hz,  Fac fault Value,    AC frequency fault value
-            'TempFault': read_single(row, 6),       # 0.1C,     Temp fault Value,   Temperature fault value
-            'FaultCode': row.registers[7],          #           Fault code,         Inverter fault bit
-            'Fault': ErrorCodes[row.registers[7]]
-        })
-
-        # row = self.client.read_input_registers(41, 1, unit=self.unit)
-        # info = merge_dicts(info, {
-        #    'IPMTemp': read_single(row, 0),         # 0.1C,     IPM Temperature,    The inside IPM in inverter Temperature
-        # })
-
-        row = self.client.read_input_registers(42, 2, unit=self.unit)
-        info = merge(info, {
-            'PBusV': read_single(row, 0),           # 0.1V,     P Bus Voltage,      P Bus inside Voltage
-            'NBusV': read_single(row, 1),           # 0.1V,     N Bus Voltage,      N Bus inside Voltage
-        })
-
-        # row = self.client.read_input_registers(44, 3, unit=self.unit)
-        # info = merge_dicts(info, {
-        #                                            #           Check Step,         Product check step
-        #                                            #           IPF,                Inverter output PF now
-        #                                            #           ResetCHK,           Reset check data
-        # })
-        #
-        # row = self.client.read_input_registers(47, 1, unit=self.unit)
-        # info = merge_dicts(info, {
-        #    'DeratingMode': row.registers[6],       #           DeratingMode,       DeratingMode
-        #    'Derating': DeratingMode[row.registers[6]]
-        # })
-
-        row = self.client.read_input_registers(48, 16, unit=self.unit)
-        info = merge(info, {
-            'Epv1_today': read_double(row, 0),      # 0.1kWh,   Epv1_today H,       PV Energy today
-                                                    # 0.1kWh,   Epv1_today L,       PV Energy today
-            'Epv1_total': read_double(row, 2),      # 0.1kWh,   Epv1_total H,       PV Energy total
-                                                    # 0.1kWh,   Epv1_total L,       PV Energy total
-            'Epv2_today': read_double(row, 4),      # 0.1kWh,   Epv2_today H,       PV Energy today
-                                                    # 0.1kWh,   Epv2_today L,       PV Energy today
-            'Epv2_total': read_double(row, 6),      # 0.1kWh,   Epv2_total H,       PV Energy total
-                                                    # 0.1kWh,   Epv2_total L,       PV Energy total
-            'Epv_total': read_double(row, 8),       # 0.1kWh,   Epv_total H,        PV Energy total
-                                                    # 0.1kWh,   Epv_total L,        PV Energy total
-            'Rac': read_double(row, 10),            # 0.1Var,   Rac H,              AC Reactive power
-                                                    # 0.1Var,   Rac L,              AC Reactive power
-            'E_rac_today': read_double(row, 12),    # 0.1kVarh, E_rac_today H,      AC Reactive energy
-                                                    # 0.1kVarh, E_rac_today L,      AC Reactive energy
-            'E_rac_total': read_double(row, 14),    # 0.1kVarh, E_rac_total H,      AC Reactive energy
-                                                    # 0.1kVarh, E_rac_total L,      AC Reactive energy
-        })
-
-        # row = self.client.read_input_registers(64, 2, unit=self.unit)
-        # info = merge_dicts(info, {
-        #    'WarningCode': row.registers[0],        #           WarningCode,        Warning Code
-        #    'WarningValue': row.registers[1],       #           WarningValue,       Warning Value
-        # })
-        #
-        # info = merge_dicts(info, self.read_fault_table('GridFault', 90, 5))
+        for group in groups:
+            self.last[group] = self.decoders[group].decode(row)
+            rate = self.rates.get(group)
+            # Slow groups are due on multiples of their rate
+            self.due[group] = (now // rate + 1) * rate if rate else 0
 
+        # Each sample carries the latest value of every group
+        info = {}
+        for values in self.last.values():
+            info.update(values)
+
+        if self.faults is not None:
+            self.faults.check(self, info, now)
         return info
 
-    # def read_fault_table(self, name, base_index, count):
-    #     fault_table = {}
-    #     for i in range(0, count):
-    #         fault_table[name + '_' + str(i)] = self.read_fault_record(base_index + i * 5)
-    #     return fault_table
-    #
-    # def read_fault_record(self, index):
-    #     row = self.client.read_input_registers(index, 5, unit=self.unit)
-    #     # TODO: Figure out how to read the date for these records?
-    #     print(row.registers[0],
-    #             ErrorCodes[row.registers[0]],
-    #             '\n',
-    #             row.registers[1],
-    #             row.registers[2],
-    #             row.registers[3],
-    #             '\n',
-    #             2000 + (row.registers[1] >> 8),
-    #             row.registers[1] & 0xFF,
-    #             row.registers[2] >> 8,
-    #             row.registers[2] & 0xFF,
-    #             row.registers[3] >> 8,
-    #             row.registers[3] & 0xFF,
-    #             row.registers[4],
-    #             '\n',
-    #             2000 + (row.registers[1] >> 4),
-    #             row.registers[1] & 0xF,
-    #             row.registers[2] >> 4,
-    #             row.registers[2] & 0xF,
-    #             row.registers[3] >> 4,
-    #             row.registers[3] & 0xF,
-    #             row.registers[4]
-    #           )
-    #     return {
-    #         'FaultCode': row.registers[0],
-    #         'Fault': ErrorCodes[row.registers[0]],
-    #         #'Time': int(datetime.datetime(
-    #         #    2000 + (row.registers[1] >> 8),
-    #         #    row.registers[1] & 0xFF,
-    #         #    row.registers[2] >> 8,
-    #         #    row.registers[2] & 0xFF,
-    #         #    row.registers[3] >> 8,
-    #         #    row.registers[3] & 0xFF
-    #         #).timestamp()),
-    #         'Value': row.registers[4]
-    #     }
+    def drop_unsupported(self):
+        # Leave the fields the unit rejected out of every sample from now on
+        def supported(field):
+            return not any(address < field.address + field.width and field.address < address + count
+                           for address, count in self.unsupported)
+
+        dropped = [field.name for field in InputRegisters if not supported(field)]
+        print('Growatt %s does not support %s, leaving them out' % (self.name, ', '.join(dropped)))
+        self.decoders = compile_groups([field for field in InputRegisters if supported(field)], InputGroups)
+
+    def read_fault_table(self):
+        # Decoded records of the fault history, None when this model has none
+        row = self.client.read_input_registers(FaultTable, FaultRecords * FaultRecordWidth, unit=self.unit)
+        if isinstance(row, ExceptionResponse):
+            return None
+        if row.isError():
+            raise row
+
+        records = []
+        for index in range(FaultRecords):
+            record = decode_fault_record(row.registers[index * FaultRecordWidth:(index + 1) * FaultRecordWidth])
+            if record is not None:
+                records.append(record)
+        return records
@@ -0,0 +1,149 @@
+import math
+import threading
+import time
+from array import array
+
+from api import send_json
+
+
+class HistoryRing:
+    # The last capacity samples of one device in fixed width columns, the
+    # time and a double per numeric field, so a sample costs a store per
+    # column and no dict is kept for it. Fields missing from a sample are
+    # NaN, text fields are not kept.
+    __slots__ = ('capacity', 'times', 'columns', 'head', 'count')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.columns = {}
+        # Slot the next sample goes to, and how many slots hold one
+        self.head = 0
+        self.count = 0
+
+    def append(self, now, fields):
+        slot = self.head
+        for name, value in fields.items():
+            if name not in self.columns and isinstance(value, (int, float)):
+                self.columns[name] = array('d', [math.nan]) * self.capacity
+        for name, column in self.columns.items():
+            value = fields.get(name)
+            column[slot] = value if isinstance(value, (int, float)) else math.nan
+        self.times[slot] = now
+        self.head = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def slot(self, index):
+        # Slot of the index'th oldest sample
+        return (self.head - self.count + index) % self.capacity
+
+    def find(self, moment):
+        # Index of the oldest sample at or after moment, times only grow
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.times[self.slot(middle)] < moment:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def select(self, start, end, names, step=0):
+        # (times, {name: values}) of the samples from start up to end. With
+        # a step the samples are averaged over step second buckets.
+        slots = [self.slot(index) for index in range(self.find(start), self.find(end))]
+        columns = [(name, self.columns[name]) for name in names]
+        if not step:
+            return ([self.times[slot] for slot in slots],
+                    {name: [column[slot] for slot in slots] for name, column in columns})
+
+        times = []
+        sums = {name: [] for name in names}
+        counts = {name: [] for name in names}
+        bucket = None
+        for slot in slots:
+            moment = self.times[slot] // step * step
+            if moment != bucket:
+                bucket = moment
+                times.append(moment)
+                for name in names:
+                    sums[name].append(0.0)
+                    counts[name].append(0)
+            for name, column in columns:
+                value = column[slot]
+                if not math.isnan(value):
+                    sums[name][-1] += value
+                    counts[name][-1] += 1
+        return times, {name: [total / count if count else math.nan for total, count in zip(sums[name], counts[name])]
+                       for name in names}
+
+
+class History:
+    # Sink keeping a HistoryRing per device with the last seconds of
+    # samples at full resolution, served as JSON on /history:
+    #
+    #   /history                     devices, their fields and time span
+    #   /history/<device>?start=-600&end=&step=10&fields=Pac,Ppv
+    #
+    # start and end are unix times, or seconds before now when negative.
+    # points=N picks the step that gives about N points.
+
+    def __init__(self, seconds=6 * 3600, interval=1):
+        self.capacity = max(1, int(seconds / interval))
+        self.rings = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings, interval):
+        return cls(settings.getfloat('api', 'history_hours', fallback=6) * 3600, interval)
+
+    def put(self, name, point):
+        with self.lock:
+            ring = self.rings.get(name)
+            if ring is None:
+                ring = self.rings[name] = HistoryRing(self.capacity)
+            ring.append(point['time'], point['fields'])
+
+    def devices(self):
+        with self.lock:
+            return {name: {
+                'samples': ring.count,
+                'start': ring.times[ring.slot(0)] if ring.count else None,
+                'end': ring.times[ring.slot(ring.count - 1)] if ring.count else None,
+                'fields': list(ring.columns),
+            } for name, ring in self.rings.items()}
+
+    def query(self, device, start=0, end=None, fields=None, step=0, points=0):
+        now = time.time()
+        if start < 0:
+            start += now
+        if end is None:
+            end = math.inf
+        elif end < 0:
+            end += now
+        with self.lock:
+            ring = self.rings[device]
+            names = list(ring.columns) if fields is None else fields
+            for name in names:
+                if name not in ring.columns:
+                    raise ValueError('Unknown field %s' % name)
+            if points and not step:
+                index = ring.find(start)
+                first = ring.times[ring.slot(index)] if index < ring.count else now
+                step = math.ceil((min(end, now) - first) / points) or 0
+            times, values = ring.select(start, end, names, step)
+        return {'device': device, 'step': step, 'time': times, 'fields': values}
+
+    def handle(self, request, path, params):
+        # ApiServer handler for /history
+        if not path:
+            send_json(request, self.devices())
+            return
+        fields = params.get('fields')
+        send_json(request, self.query(
+            path,
+            float(params.get('start', 0)),
+            float(params['end']) if params.get('end') else None,
+            fields.split(',') if fields else None,
+            float(params.get('step', 0)),
+            int(params.get('points', 0))))
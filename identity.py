@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+
+
+class IdentityCache:
+    # What we know about every unit, kept in a JSON file keyed by bus and
+    # unit: its kind and the identity it reported, eg. firmware and serial
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.units = {}
+        try:
+            with open(path) as f:
+                self.units = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as err:
+            print('Ignoring the identity cache %s' % path)
+            print(err)
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Defaults to identity.json next to the script, empty disables it
+        path = settings.get('solarmon', 'identity_cache', fallback=None)
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'identity.json')
+        if not path:
+            return None
+        return cls(path)
+
+    @staticmethod
+    def key(bus, unit):
+        return '%s:%d' % (bus, unit)
+
+    def get(self, bus, unit):
+        with self.lock:
+            entry = self.units.get(self.key(bus, unit))
+        return None if entry is None else entry.get('identity')
+
+    def put(self, bus, unit, kind, identity=None):
+        # Returns whether anything changed, the file is only written then
+        key = self.key(bus, unit)
+        with self.lock:
+            entry = self.units.get(key, {})
+            if entry.get('kind') == kind and entry.get('identity') == identity:
+                return False
+            self.units[key] = {'kind': kind, 'identity': identity, 'updated': int(time.time())}
+            self.save()
+        return True
+
+    def save(self):
+        # Replaced in one go so a crash never leaves half a file
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.units, f, indent=2, sort_keys=True)
+        os.replace(temporary, self.path)
+
+
+class Identified:
+    # Builds the reader on first use and keeps retrying on later polls, for
+    # units that may not answer at startup. With a cached identity the
+    # reader is built without touching the bus so sampling starts right
+    # away. The identity is read again once the unit answers a poll, and
+    # the cache updated if it changed, eg. after a firmware update.
+
+    def __init__(self, factory, cache, bus, unit, kind):
+        # factory(identity) builds the reader, reading the identity itself
+        # when given None
+        self.factory = factory
+        self.cache = cache
+        self.bus = bus
+        self.unit = unit
+        self.kind = kind
+        self.reader = None
+        self.validated = False
+
+    def read(self):
+        if self.reader is None:
+            identity = self.cache.get(self.bus, self.unit) if self.cache is not None else None
+            self.reader = self.factory(identity)
+            self.validated = identity is None
+            self.store()
+            self.reader.print_info()
+
+        info = self.reader.read()
+        if info is not None and not self.validated:
+            self.revalidate()
+        return info
+
+    def revalidate(self):
+        try:
+            identity = self.reader.read_identity()
+        except Exception as err:
+            # Tried again after the next answered poll
+            print('Failed to read the identity of %s' % self.reader.name)
+            print(err)
+            return
+        self.validated = True
+        if identity != self.reader.identity:
+            print('%s changed identity' % self.reader.name)
+            self.reader.set_identity(identity)
+            self.reader.print_info()
+        self.store()
+
+    def store(self):
+        if self.cache is not None:
+            self.cache.put(self.bus, self.unit, self.kind, self.reader.identity)
@@ -0,0 +1,193 @@
+import queue
+import threading
+import time
+
+from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError
+from influxdb.line_protocol import make_lines
+
+from metrics import Histogram
+from spool import Spool
+
+
+def connect(settings):
+    # A single client is only ever used from the writer thread, so its
+    # requests session keeps one connection alive between flushes
+    db_name = settings.get('influx', 'db_name', fallback='inverter')
+    influx = InfluxDBClient(host=settings.get('influx', 'host', fallback='localhost'),
+                            port=settings.getint('influx', 'port', fallback=8086),
+                            username=settings.get('influx', 'username', fallback=None),
+                            password=settings.get('influx', 'password', fallback=None),
+                            database=db_name,
+                            timeout=settings.getfloat('influx', 'timeout', fallback=10),
+                            pool_size=1,
+                            gzip=settings.getboolean('influx', 'gzip', fallback=False))
+    try:
+        influx.create_database(db_name)
+    except Exception as err:
+        # Points are spooled until the database is reachable
+        print('Failed to create DB!')
+        print(err)
+    return influx
+
+
+class InfluxWriter:
+    # Queues points from every source and writes them from a background
+    # thread in batches, once batch_size points are waiting or the oldest
+    # one is flush_interval seconds old. Batches that cannot be written
+    # because the database is unreachable or fails (5xx) go to the spool and
+    # are replayed once it is back. Batches it rejects (4xx, eg. a field
+    # type conflict) would be rejected again, they are dropped and counted.
+
+    def __init__(self, influx, batch_size=500, flush_interval=5, queue_size=100000, time_precision='s',
+                 spool=None, replay_bytes=1024 * 1024, retry_interval=15, max_retry_interval=300):
+        self.influx = influx
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.time_precision = time_precision
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.rejected = 0
+        self.write_failures = 0
+        self.latency = Histogram()
+
+        self.spool = spool
+        self.replay_bytes = replay_bytes
+        self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
+        self.retry_delay = retry_interval
+        self.retry_at = 0
+        self.replayed = 0
+
+        self.thread = threading.Thread(target=self.run, name='influx', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_settings(cls, influx, settings, name):
+        return cls(influx,
+                   batch_size=settings.getint('influx', 'batch_size', fallback=500),
+                   flush_interval=settings.getfloat('influx', 'flush_interval', fallback=5),
+                   queue_size=settings.getint('influx', 'queue_size', fallback=100000),
+                   spool=Spool.from_settings(settings, name),
+                   retry_interval=settings.getfloat('influx', 'retry_interval', fallback=15))
+
+    @property
+    def depth(self):
+        return self.queue.qsize()
+
+    def put(self, name, point):
+        self.write(point)
+
+    def write(self, point):
+        # Never blocks, when the queue is full the oldest point is dropped
+        while True:
+            try:
+                self.queue.put_nowait(point)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def pending(self):
+        return self.spool is not None and len(self.spool) > 0
+
+    def run(self):
+        batch = []
+        deadline = None
+        while True:
+            wake = [moment for moment in (deadline, self.retry_at if self.pending() else None) if moment is not None]
+            timeout = max(0, min(wake) - time.monotonic()) if wake else None
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            if batch and (len(batch) >= self.batch_size or time.monotonic() >= deadline):
+                self.flush(batch)
+                batch = []
+                deadline = None
+
+            # Live points always go first, the spool is replayed one chunk at
+            # a time in between
+            if self.pending() and time.monotonic() >= self.retry_at:
+                self.replay()
+
+    def online(self):
+        self.retry_delay = self.retry_interval
+        self.retry_at = 0
+
+    def offline(self):
+        self.retry_at = time.monotonic() + self.retry_delay
+        self.retry_delay = min(self.retry_delay * 2, self.max_retry_interval)
+
+    def flush(self, batch):
+        # While the database is known to be down go straight to the spool
+        if self.spool is None or time.monotonic() >= self.retry_at:
+            started = time.perf_counter()
+            try:
+                if self.influx.write_points(batch, time_precision=self.time_precision):
+                    self.latency.observe(time.perf_counter() - started)
+                    self.written += len(batch)
+                    self.online()
+                    return
+                print('Failed to write to DB!')
+            except InfluxDBClientError as err:
+                self.latency.observe(time.perf_counter() - started)
+                self.reject(len(batch), err)
+                return
+            except Exception as err:
+                print('Failed to write to DB!')
+                print(err)
+            self.latency.observe(time.perf_counter() - started)
+            self.write_failures += 1
+            self.offline()
+        self.store(batch)
+
+    def reject(self, points, err):
+        # The database answered, it is up, but will never take these points
+        self.rejected += points
+        self.online()
+        print('%d points rejected by DB!' % points)
+        print(err)
+
+    def store(self, batch):
+        if self.spool is None:
+            self.failed += len(batch)
+            print('%d points lost, %d queued' % (len(batch), self.depth))
+            return
+
+        lines = make_lines({'points': batch}, self.time_precision).rstrip('\n')
+        self.spool.append(lines.encode('utf-8'))
+        self.spool.flush()
+
+    def replay(self):
+        records = self.spool.peek(self.replay_bytes)
+        try:
+            if self.influx.write_points([record.decode('utf-8') for record in records],
+                                        time_precision=self.time_precision, protocol='line'):
+                self.spool.pop(len(records))
+                self.replayed += len(records)
+                self.online()
+                if not self.pending():
+                    print('Spool replayed')
+                return
+            print('Failed to replay spool to DB!')
+        except InfluxDBClientError as err:
+            # Retrying would only block the rest of the spool behind it
+            self.spool.pop(len(records))
+            self.reject(sum(record.count(b'\n') + 1 for record in records), err)
+            return
+        except Exception as err:
+            print('Failed to replay spool to DB!')
+            print(err)
+        self.write_failures += 1
+        self.offline()
@@ -0,0 +1,134 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds of the latency histogram buckets
+Buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    # Counts of observations per bucket, cumulated only when scraped so an
+    # observation is a bisect and two additions
+
+    def __init__(self, buckets=Buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def labels(values):
+    if not values:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                             for key, value in values.items())
+
+
+class Metrics:
+    # Series are read from the counters the poller, clients and sinks keep
+    # anyway, by callbacks run when the endpoint is scraped. Nothing is
+    # done per sample unless someone is looking.
+
+    def __init__(self):
+        self.series = []
+
+    def add(self, name, kind, help, collect):
+        # collect() returns [(labels, value)], value is a Histogram for
+        # kind 'histogram'
+        self.series.append((name, kind, help, collect))
+
+    def render(self):
+        lines = []
+        for name, kind, help, collect in self.series:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for values, value in collect():
+                if kind != 'histogram':
+                    lines.append('%s%s %s' % (name, labels(values), float(value)))
+                    continue
+                total = 0
+                for bound, count in zip(value.buckets + ('+Inf',), value.counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' % (name, labels(dict(values, le=bound)), total))
+                lines.append('%s_sum%s %s' % (name, labels(values), value.sum))
+                lines.append('%s_count%s %d' % (name, labels(values), value.count))
+        return '\n'.join(lines) + '\n'
+
+    def add_poller(self, poller):
+        self.add('solarmon_poll_overruns_total', 'counter', 'Polls that started after their slot',
+                 lambda: [({}, poller.overruns)])
+        self.add('solarmon_poll_errors_total', 'counter', 'Polls that raised an error',
+                 lambda: [({'device': name}, count) for name, count in poller.errors.items()])
+        self.add('solarmon_error_sleep_seconds_total', 'counter', 'Seconds waited after failed polls',
+                 lambda: [({'device': name}, seconds) for name, seconds in poller.error_sleep.items()])
+        self.add('solarmon_poll_retry_delay_seconds', 'gauge', 'Current backoff of offline or failing devices',
+                 lambda: [({'device': name}, delay) for name, delay in poller.delays.items()])
+
+    def add_clients(self, clients):
+        # clients is {device: TimedClient}
+        self.add('solarmon_modbus_transaction_seconds', 'histogram', 'Modbus transaction latency',
+                 lambda: [({'device': name}, client.latency) for name, client in clients.items()])
+        self.add('solarmon_modbus_errors_total', 'counter', 'Failed Modbus transactions',
+                 lambda: [({'device': name, 'kind': kind}, count)
+                          for name, client in clients.items() for kind, count in client.errors.items()])
+
+    def add_writer(self, writer):
+        self.add('solarmon_influx_write_seconds', 'histogram', 'InfluxDB write latency',
+                 lambda: [({}, writer.latency)])
+        self.add('solarmon_influx_points_total', 'counter', 'Points by outcome',
+                 lambda: [({'outcome': 'written'}, writer.written), ({'outcome': 'failed'}, writer.failed),
+                          ({'outcome': 'rejected'}, writer.rejected), ({'outcome': 'dropped'}, writer.dropped), ({'outcome': 'replayed'}, writer.replayed)])
+        self.add('solarmon_influx_write_failures_total', 'counter', 'Failed InfluxDB writes',
+                 lambda: [({}, writer.write_failures)])
+        self.add('solarmon_influx_queue_depth', 'gauge', 'Points waiting to be written',
+                 lambda: [({}, writer.depth)])
+
+    def add_mqtt(self, sink):
+        self.add('solarmon_mqtt_publish_failures_total', 'counter', 'MQTT messages that failed to publish',
+                 lambda: [({}, sink.failures)])
+        self.add('solarmon_mqtt_reconnects_total', 'counter', 'MQTT connections after the first',
+                 lambda: [({}, max(0, sink.connects - 1))])
+
+    def add_stream(self, stream):
+        self.add('solarmon_stream_clients', 'gauge', 'Clients connected to the event stream',
+                 lambda: [({}, len(stream.clients))])
+        self.add('solarmon_stream_dropped_total', 'counter', 'Events dropped for clients that fell behind',
+                 lambda: [({}, stream.dropped_total())])
+
+
+class MetricsServer:
+    # Serves the metrics in the Prometheus text format on /metrics
+
+    def __init__(self, metrics, host='127.0.0.1', port=9108):
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='metrics', daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def from_settings(cls, metrics, settings):
+        # Returns None when the [metrics] section is missing
+        if not settings.has_section('metrics'):
+            return None
+        return cls(metrics, settings.get('metrics', 'host', fallback='127.0.0.1'),
+                   settings.getint('metrics', 'port', fallback=9108))
@@ -0,0 +1,49 @@
+import json
+from datetime import datetime
+
+
+class MqttSink:
+    # Publishes every sample as a Tasmota style {"Time": ..., "ENERGY": {...}}
+    # message. paho only queues the message, so this is safe to call from
+    # the poll loop. Events use their own key and are stamped with the time
+    # of the point rather than the time of publishing. With devices only
+    # the samples of those devices are published.
+
+    def __init__(self, client, topic, deadband=None, key='ENERGY', event=False, devices=None):
+        self.client = client
+        self.topic = topic
+        self.devices = devices
+        self.deadband = deadband
+        self.key = key
+        self.event = event
+        self.failures = 0
+        self.connects = 0
+
+    def on_connect(self, client, userdata, flags, rc):
+        # paho callback, every connect after the first is a reconnect
+        if rc == 0:
+            self.connects += 1
+
+    def put(self, name, point):
+        if self.devices is not None and name not in self.devices:
+            return
+        if self.deadband is not None:
+            point = self.deadband.filter(name, point)
+            if point is None:
+                return
+
+        mqttmessage = {}
+        if self.event:
+            mqttmessage["Time"] = datetime.fromtimestamp(point['time']).isoformat()
+        else:
+            mqttmessage["Time"] = datetime.now().isoformat(timespec='milliseconds')
+        mqttmessage[self.key] = point['fields']
+        try:
+            # paho reconnects in its network loop, a publish while the
+            # connection is down only fails
+            if self.client.publish(self.topic, json.dumps(mqttmessage)).rc != 0:
+                self.failures += 1
+        except Exception as err:
+            print("Failed to publish mqtt message to broker!")
+            print(err)
+            self.failures += 1
@@ -0,0 +1,160 @@
+import json
+import queue
+import threading
+
+from streamjoin import message_time
+
+
+def json_loads(payload):
+    # MQTT payloads are UTF-8, decoding them first spares json.loads its
+    # encoding detection on bytes
+    return json.loads(payload.decode('utf-8') if type(payload) is bytes else payload)
+
+
+# orjson parses several times faster when it is installed
+try:
+    import orjson
+    loads = orjson.loads
+except ImportError:
+    loads = json_loads
+
+# Field types of the ENERGY object Tasmota publishes for a PZEM-004T
+TasmotaEnergy = {
+    'Total': float,
+    'Yesterday': float,
+    'Today': float,
+    'Period': int,
+    'Power': int,
+    'ApparentPower': int,
+    'ReactivePower': int,
+    'Factor': float,
+    'Voltage': int,
+    'Current': float,
+    'Frequency': int,
+}
+
+
+def number(value):
+    # Type of fields the schema does not know: numbers are kept, numeric
+    # strings converted and anything else dropped
+    if type(value) is str:
+        try:
+            return int(value)
+        except ValueError:
+            return float(value)
+    if type(value) in (int, float):
+        return value
+    raise TypeError(value)
+
+
+def truncated(value):
+    # number() for truncating schemas, floats become integers the way the
+    # int() parser before schemas stored them
+    if type(value) is float:
+        return int(value)
+    return number(value)
+
+
+def field_types(fields):
+    # Types of the fields a RegisterDecoder produces for a register map
+    types = {}
+    for field in fields:
+        types[field.name] = int if field.scale is None else float
+        if field.codes is not None:
+            types[field.codes[0]] = str
+    return types
+
+
+class Schema:
+    # Parser for one topic, compiled from {field: type}. Every known field
+    # costs a single dict lookup and a type check, values already of the
+    # right type are not converted and conversions only happen for strings
+    # or mismatched numbers. Fields that fail to convert are dropped. With
+    # truncate fractional values are kept as integers, like the parser
+    # before schemas did, see float_fields in solarmon.cfg.
+
+    def __init__(self, types, key='ENERGY', loads=loads, truncate=False):
+        self.key = key
+        self.loads = loads
+        if truncate:
+            types = {name: int if kind is float else kind for name, kind in types.items()}
+        self.steps = tuple(types.items())
+        self.number = truncated if truncate else number
+        # Last value of each unknown field that could not be converted, so
+        # a constant one like Tasmota's TotalStartTime is only tried once
+        self.rejected = {}
+
+    def fields(self, values):
+        fields = {}
+        for name, kind in self.steps:
+            value = values.get(name)
+            if value is None:
+                continue
+            if type(value) is not kind:
+                try:
+                    value = kind(value)
+                except (TypeError, ValueError):
+                    continue
+            fields[name] = value
+
+        if len(fields) < len(values):
+            rejected = self.rejected
+            for name, value in values.items():
+                if name not in fields and (name not in rejected or rejected[name] != value):
+                    try:
+                        fields[name] = self.number(value)
+                    except (TypeError, ValueError):
+                        rejected[name] = value
+        return fields
+
+    def parse(self, payload, fallback=None):
+        # (timestamp, fields) of a {"Time": ..., key: {...}} message, the
+        # timestamp is fallback when the message has no usable Time
+        message = self.loads(payload)
+        return message_time(message, fallback), self.fields(message[self.key])
+
+    def parse_fields(self, payload):
+        # Only the fields, for handlers that stamp messages when they arrive
+        return self.fields(self.loads(payload)[self.key])
+
+
+class Ingest:
+    # MQTT callbacks made by callback(handle) only queue the payload, a
+    # worker thread drains the queue in batches of up to batch_size and
+    # calls handle(payload) for each message. Parsing and everything after
+    # it run off paho's network thread, and a burst of messages costs one
+    # wakeup instead of one per message.
+
+    def __init__(self, batch_size=100):
+        self.batch_size = batch_size
+        self.queue = queue.SimpleQueue()
+        self.received = 0
+        self.failed = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def callback(self, handle):
+        def on_message(client, userdata, message):
+            self.queue.put((handle, message.payload))
+        return on_message
+
+    def drain(self):
+        batch = [self.queue.get()]
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.drain()
+            self.received += len(batch)
+            for handle, payload in batch:
+                try:
+                    handle(payload)
+                except Exception as err:
+                    print("Failed to process mqtt message!")
+                    print(err)
+                    self.failed += 1
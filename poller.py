@@ -0,0 +1,158 @@
+import asyncio
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Bus:
+    # A single worker thread owns the client, so transactions on one line
+    # never overlap while the event loop stays free. Clients that can carry
+    # several transactions at once (a pool of TCP connections) get one
+    # worker per connection.
+    def __init__(self, name, client, workers=1):
+        self.name = name
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bus-' + name)
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+
+class Device:
+    def __init__(self, name, bus, reader, measurement):
+        self.name = name
+        self.bus = bus
+        self.reader = reader
+        self.measurement = measurement
+
+
+class LatestValues:
+    # Sink keeping the last point of every device for cheap lookups from
+    # other threads
+    def __init__(self):
+        self.points = {}
+
+    def put(self, name, point):
+        self.points[name] = point
+
+    def get(self, name, max_age=None):
+        point = self.points.get(name)
+        if point is None or (max_age is not None and time.time() - point['time'] > max_age):
+            return None
+        return point['fields']
+
+
+class Backoff:
+    # Delay doubling from start up to limit on every failure in a row
+    def __init__(self, start, limit):
+        self.start = min(start, limit)
+        self.limit = limit
+        self.delay = None
+
+    def next(self):
+        self.delay = self.start if self.delay is None else min(self.delay * 2, self.limit)
+        return self.delay
+
+    def reset(self):
+        self.delay = None
+
+
+class Poller:
+    # A unit that is offline or erroring is retried after backoff seconds,
+    # doubling up to offline_interval or error_interval while it stays that
+    # way. With a solar schedule such units are only probed every so often
+    # at night, inverters without sun usually stop answering altogether,
+    # and the backoff starts over at dawn.
+    def __init__(self, interval=1, offline_interval=60, error_interval=60, debug=False, backoff=5, schedule=None):
+        self.interval = interval
+        self.offline_interval = offline_interval
+        self.error_interval = error_interval
+        self.backoff = backoff
+        self.schedule = schedule
+        # Print every sample
+        self.debug = debug
+        self.devices = []
+        self.sinks = []
+        self.overruns = 0
+        # Per device: polls that raised and seconds spent waiting after them
+        self.errors = {}
+        self.error_sleep = {}
+        # Per device: seconds until the next poll while offline or erroring
+        self.delays = {}
+
+    def add_device(self, device):
+        self.devices.append(device)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def emit(self, name, point):
+        # Sinks only queue the point, they must never block the loop
+        for sink in self.sinks:
+            sink.put(name, point)
+
+    def next_deadline(self, deadline, delay):
+        # Deadlines advance on a fixed grid so read and write time does not
+        # make the interval drift. If we overran, skip the missed slots.
+        deadline += delay
+        now = time.time()
+        if deadline < now:
+            self.overruns += 1
+            deadline += math.ceil((now - deadline) / self.interval) * self.interval
+        return deadline
+
+    def retry_delay(self, backoff, now):
+        if self.schedule is not None:
+            delay = self.schedule.night_delay(now)
+            if delay is not None:
+                backoff.reset()
+                return delay
+        return backoff.next()
+
+    async def poll(self, device):
+        deadline = math.ceil(time.time() / self.interval) * self.interval
+        offline = Backoff(self.backoff, self.offline_interval)
+        errors = Backoff(self.backoff, self.error_interval)
+        while True:
+            await asyncio.sleep(max(0, deadline - time.time()))
+
+            now = time.time()
+            try:
+                info = await device.bus.run(device.reader.read)
+            except Exception as err:
+                print(device.name)
+                print(err)
+                # If this inverter errored then we wait a bit before trying again
+                self.delays[device.name] = self.retry_delay(errors, now)
+                deadline = self.next_deadline(deadline, self.delays[device.name])
+                self.errors[device.name] = self.errors.get(device.name, 0) + 1
+                self.error_sleep[device.name] = self.error_sleep.get(device.name, 0) + max(0, deadline - time.time())
+                continue
+
+            if info is None:
+                # No power is being generated so check back later
+                errors.reset()
+                self.delays[device.name] = self.retry_delay(offline, now)
+                deadline = self.next_deadline(deadline, self.delays[device.name])
+                continue
+
+            offline.reset()
+            errors.reset()
+            self.delays[device.name] = 0
+
+            point = {
+                'time': int(now),
+                'measurement': device.measurement,
+                'fields': info
+            }
+
+            if self.debug:
+                print(device.name)
+                print(point)
+
+            self.emit(device.name, point)
+            deadline = self.next_deadline(deadline, self.interval)
+
+    async def run(self):
+        await asyncio.gather(*[self.poll(device) for device in self.devices])
+
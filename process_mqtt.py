@@ -2,116 +2,79 @@
 
 import os
 import time
-import json
-from decimal import *
-getcontext().prec = 2
 
 from configparser import RawConfigParser
 import paho.mqtt.client as mqtt
 
+import influxwriter
+from deadband import Deadband
+from growatt import InputRegisters
+from influxwriter import InfluxWriter
+from payload import Ingest, Schema, TasmotaEnergy, field_types
+from rollingstats import GridMetrics
+from streamjoin import StreamJoin
+
 settings = RawConfigParser()
 settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
 
-offline_interval = settings.getint('query', 'offline_interval', fallback=60)
-
 broker_address = settings.get('mqtt', 'broker_address', fallback='iot.eclipse.org')
 mqtt_subscribe_pzem = settings.get('mqtt', 'subscribe-pzem', fallback='tele/pzem004t/SENSOR')
 mqtt_subscribe_growatt = settings.get('mqtt', 'subscribe-growatt', fallback='tele/growatt/SENSOR')
 mqtt_measurement = settings.get('mqtt', 'measurement', fallback='grid')
 
-energy_parsed = None
-
-vdiffarr = [0.0] * 5
-
-lastgrowattpower = Decimal('0.0')
-lastgridpower = Decimal('0.0')
-powerdirection = 1 # 1 - consume power from grid, -1 - supply power to grid.
-
-def on_pzem_message(client, userdata, message):
-
-    getcontext().prec = 2
-    global energy_parsed
-    payload = str(message.payload.decode("utf-8"))
-    print("message received ", payload)
-    mqtt_message = json.loads(payload)
-    energy = mqtt_message["ENERGY"]
-    energy_parsed = {}
-    for i, (k, v) in enumerate(energy.items()):
-        try:
-            energy_parsed[k] = int(v)
-        except ValueError:
-            try:
-                energy_parsed[k] = float(v)
-            except ValueError:
-                payload = payload
-
-
-def on_growatt_message(client, userdata, message):
-    return
-    global energy_parsed
-    getcontext().prec = 2
-
-    now = time.time()
-    growattinfo = process_inverters(now)
-
-    payload = str(message.payload.decode("utf-8"))
-    print("message received ", payload)
-    mqtt_message = json.loads(payload)
-    energy = mqtt_message["ENERGY"]
-    energy_parsed = {}
-    for i, (k, v) in enumerate(energy.items()):
-        try:
-            energy_parsed[k] = int(v)
-        except ValueError:
-            try:
-                energy_parsed[k] = float(v)
-            except ValueError:
-                payload = payload
-
-    if growattinfo is None:
-        lastgrowattpower = Decimal('0.0')
-        powerdirection = 1
-    else:
-        growattpower = Decimal(growattinfo['Pac'])
-        gridpower = Decimal(energy_parsed['Power'])
-        growattpowerdiff = growattpower - lastgrowattpower
-        gridpowerdiff = gridpower - lastgridpower
-        print('growattpowerdiff ', growattpowerdiff, 'gridpowerdiff ', gridpowerdiff)
-        # If increased growatt power generation increses grid power - we are supplying power to grid:
-        if (growattpower < gridpower):
-            powerdirection = 1
-        elif (growattpowerdiff > 0 and gridpowerdiff > 0):
-            powerdirection = -1
-        # If decresed growwat power generation increases grid power - we are also supplying power to grid:
-        elif (growattpowerdiff < 0 and gridpowerdiff < 0):
-            powerdirection = -1
-        # if power value does not changed - leave as is
-        elif (growattpowerdiff == 0 or gridpowerdiff == 0):
-            powerdirection = powerdirection
-        else:
-            powerdirection = 1
-        
-        lastgrowattpower = Decimal(growattinfo['Pac'])
-        lastgridpower = Decimal(energy_parsed['Power'])
-        # publish growatt info to mqtt broker also. 
-        mqttmessage = {}
-        mqttmessage["Time"] = datetime.now().isoformat(timespec='milliseconds')
-        mqttmessage["ENERGY"] = growattinfo
-        try:
-            mqttclient.publish("tele/growatt/SENSOR",json.dumps(mqttmessage)) #publish
-        except:
-            mqttclient.connect(broker_address) # reconect if connection lost.
-            mqttclient.publish("tele/growatt/SENSOR",json.dumps(mqttmessage)) #publish
-    energy_parsed['powerdirection'] = powerdirection
-        
-    points = [{
+# Grid meter samples are joined with the growatt sample closest in time
+# (join = nearest) or the mean of the growatt samples around it (join = window)
+join_mode = settings.get('mqtt', 'join', fallback='nearest')
+join_window = settings.getfloat('mqtt', 'join_window', fallback=2)
+join_lateness = settings.getfloat('mqtt', 'join_lateness', fallback=2)
+join_buffer = settings.getint('mqtt', 'join_buffer', fallback=600)
+batch_size = settings.getint('mqtt', 'batch_size', fallback=100)
+# Existing databases hold the fractional grid meter values as integers
+float_fields = settings.getboolean('mqtt', 'float_fields', fallback=False)
+
+# Power direction and rolling voltage difference statistics over the last
+# vdiff_window grid samples
+metrics = GridMetrics(settings.getint('mqtt', 'vdiff_window', fallback=5))
+
+# The growatt messages may only carry the fields that changed
+growattstate = {}
+
+print('Setup InfluxDB Client... ', end='')
+influx = influxwriter.connect(settings)
+writer = InfluxWriter.from_settings(influx, settings, 'process_mqtt')
+output = Deadband.from_settings(writer, settings)
+print('Done!')
+
+# The grid meter publishes Tasmota ENERGY messages, the growatt topic the
+# fields solarmon-mqtt.py decodes from the inverter registers
+pzem_schema = Schema(TasmotaEnergy, truncate=not float_fields)
+# The growatt fields are only joined, never written, and keep their
+# full precision for the voltage difference
+growatt_schema = Schema(field_types(InputRegisters))
+
+def on_join(now, energy_parsed, growattinfo):
+    fields = dict(energy_parsed)
+    fields.update(metrics.update(energy_parsed, growattinfo))
+
+    output.put(mqtt_measurement, {
         'time': int(now),
         'measurement': mqtt_measurement,
-        "fields": energy_parsed
-    }]
-    if not influx.write_points(points, time_precision='s'):
-        print("Failed to write to DB!")
-    return
+        "fields": fields
+    })
+
+join = StreamJoin(on_join, join_window, join_lateness, join_mode, join_buffer)
+
+def on_pzem_message(payload):
+    now, energy_parsed = pzem_schema.parse(payload, time.time())
+    join.add_left(now, energy_parsed)
+
+def on_growatt_message(payload):
+    now, energy_parsed = growatt_schema.parse(payload, time.time())
+    growattstate.update(energy_parsed)
+    join.add_right(now, dict(growattstate))
+
+# Messages are parsed in batches on the ingest thread
+ingest = Ingest(batch_size)
 
 ### topic message
 def on_message(mosq, obj, msg):
@@ -123,8 +86,8 @@ def on_log(client, userdata, level, buf):
 
 print('Setup mqtt Connection... ', end='')
 mqttclient = mqtt.Client("PROCESS")
-mqttclient.message_callback_add(mqtt_subscribe_pzem, on_pzem_message)
-mqttclient.message_callback_add(mqtt_subscribe_growatt, on_growatt_message)
+mqttclient.message_callback_add(mqtt_subscribe_pzem, ingest.callback(on_pzem_message))
+mqttclient.message_callback_add(mqtt_subscribe_growatt, ingest.callback(on_growatt_message))
 mqttclient.on_message=on_message #attach function to callback
 # mqttclient.on_log=on_log
 mqttclient.connect(broker_address) #connect to broker
@@ -133,5 +96,6 @@ mqttclient.subscribe([(mqtt_subscribe_pzem, 0), (mqtt_subscribe_growatt, 0)])
 print('Done with MQTT!')
 
 while True:
-    time.sleep(offline_interval)
-
+    # Grid samples without a growatt sample in time are joined with nothing
+    time.sleep(1)
+    join.expire(time.time())
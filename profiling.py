@@ -0,0 +1,175 @@
+import cProfile
+import io
+import pstats
+import threading
+import time
+import tracemalloc
+from functools import wraps
+
+import deadband
+import growatt
+import influxwriter
+import mqttsink
+import payload
+import poller
+import pzem
+import registers
+import rollingstats
+import rollup
+import transport
+
+# (class, method, stage) timed with --profile. Entry points are where a
+# thread enters the pipeline, they also run under cProfile for --cycles.
+Stages = [
+    (growatt.Growatt, 'read', 'poll'),
+    (pzem.Pzem, 'read', 'poll'),
+    (transport.ReconnectingClient, 'call', 'modbus'),
+    (registers.RegisterDecoder, 'decode', 'decode'),
+    (poller.Poller, 'emit', 'sinks'),
+    (deadband.Deadband, 'filter', 'deadband'),
+    (rollup.Rollup, 'put', 'rollup'),
+    (influxwriter.InfluxWriter, 'write', 'influx queue'),
+    (influxwriter.InfluxWriter, 'flush', 'influx write'),
+    (influxwriter.InfluxWriter, 'replay', 'influx replay'),
+    (mqttsink.MqttSink, 'put', 'mqtt publish'),
+    (payload.Schema, 'parse', 'mqtt parse'),
+    (rollingstats.GridMetrics, 'update', 'grid metrics'),
+]
+Entries = {'poll', 'sinks', 'influx write', 'mqtt message'}
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true',
+                        help='time every stage of the pipeline and print a report periodically')
+    parser.add_argument('--cycles', type=int, default=0,
+                        help='with --profile, run cProfile for the first N polls of every device')
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help='with --profile, add the biggest allocation changes to every report')
+    parser.add_argument('--report', type=float, default=60, help='seconds between reports')
+    parser.add_argument('--output', help='also write the cProfile stats to this file')
+
+
+class Profiler:
+    # Wall time per stage from perf_counter, about a microsecond per call.
+    # cProfile is per thread, so each thread entering the pipeline gets its
+    # own profile and they are merged for the report.
+
+    def __init__(self, cycles=0, memory=False, interval=60, output=None):
+        self.cycles = cycles
+        self.memory = memory
+        self.interval = interval
+        self.output = output
+        self.lock = threading.Lock()
+        # stage: [calls, seconds, max seconds] since the last report
+        self.stages = {}
+        self.local = threading.local()
+        self.profiles = []
+        self.polls = 0
+        self.limit = None
+        self.profiling = cycles > 0
+        self.snapshot = None
+        self.poller = None
+
+    @classmethod
+    def from_args(cls, args):
+        # Returns None without --profile
+        if not args.profile:
+            return None
+        profiler = cls(args.cycles, args.tracemalloc, args.report, args.output)
+        profiler.instrument()
+        return profiler
+
+    def instrument(self):
+        for owner, name, stage in Stages:
+            setattr(owner, name, self.wrap(getattr(owner, name), stage))
+
+    def wrap(self, func, stage):
+        entry = stage in Entries
+        lock = self.lock
+
+        @wraps(func)
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                if entry and self.profiling:
+                    return self.profile().runcall(func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with lock:
+                    stat = self.stages.get(stage)
+                    if stat is None:
+                        stat = self.stages[stage] = [0, 0.0, 0.0]
+                    stat[0] += 1
+                    stat[1] += elapsed
+                    if elapsed > stat[2]:
+                        stat[2] = elapsed
+                if stage == 'poll':
+                    self.count_poll()
+        return timed
+
+    def profile(self):
+        profile = getattr(self.local, 'profile', None)
+        if profile is None:
+            profile = self.local.profile = cProfile.Profile()
+            with self.lock:
+                self.profiles.append(profile)
+        return profile
+
+    def count_poll(self):
+        with self.lock:
+            self.polls += 1
+            done = self.profiling and self.limit is not None and self.polls >= self.limit
+            if done:
+                self.profiling = False
+        if done:
+            print(self.profile_report())
+
+    def start(self, poller):
+        self.poller = poller
+        self.limit = self.cycles * len(poller.devices)
+        if self.memory:
+            tracemalloc.start(10)
+            self.snapshot = tracemalloc.take_snapshot()
+        threading.Thread(target=self.run, name='profiler', daemon=True).start()
+
+    def run(self):
+        started = time.perf_counter()
+        while True:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            print(self.report(now - started))
+            started = now
+
+    def report(self, elapsed):
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        lines = ['Profile of the last %.0f s, %d overruns' % (elapsed, self.poller.overruns if self.poller else 0),
+                 '%-16s %8s %10s %7s %10s %10s' % ('stage', 'calls', 'total s', 'wall %', 'mean ms', 'max ms')]
+        for stage, (calls, total, longest) in sorted(stages.items(), key=lambda item: -item[1][1]):
+            lines.append('%-16s %8d %10.3f %7.1f %10.3f %10.3f' % (
+                stage, calls, total, total / elapsed * 100, total / calls * 1000, longest * 1000))
+        if self.memory:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            lines.append('Memory %.1f KiB, peak %.1f KiB, largest changes:' % (current / 1024, peak / 1024))
+            for stat in snapshot.compare_to(self.snapshot, 'lineno')[:10]:
+                lines.append('  %s' % stat)
+            self.snapshot = snapshot
+        return '\n'.join(lines)
+
+    def profile_report(self):
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = None
+        for profile in profiles:
+            if stats is None:
+                stats = pstats.Stats(profile, stream=io.StringIO())
+            else:
+                stats.add(profile)
+        if stats is None:
+            return 'No polls were profiled'
+        if self.output:
+            stats.dump_stats(self.output)
+        stats.sort_stats('cumulative').print_stats(30)
+        return 'cProfile of the first %d polls of every device:\n%s' % (self.cycles, stats.stream.getvalue())
@@ -0,0 +1,34 @@
+from readplan import ReadPlan
+from registers import Field, RegisterDecoder
+
+# Input registers of the PZEM-004T v3.0 energy meter, 32 bit values are low word first
+InputRegisters = [
+    #     Name,         Address, Width, Scale, Unit
+    Field('Voltage',     0,      1,     10,    'V'),
+    Field('Current',     1,      2,     1000,  'A'),
+    Field('Power',       3,      2,     10,    'W'),
+    Field('Total',       5,      2,     1000,  'kWh'),
+    Field('Frequency',   7,      1,     10,    'Hz'),
+    Field('Factor',      8,      1,     100,   'N/A'),
+    Field('Alarm',       9,      1,     None,  'N/A'),  # 0xFFFF when the power alarm is on
+]
+
+InputDecoder = RegisterDecoder(InputRegisters, low_word_first=True)
+
+class Pzem:
+    def __init__(self, client, name, unit):
+        self.client = client
+        self.name = name
+        self.unit = unit
+        self.plan = ReadPlan(InputDecoder.ranges())
+
+    def print_info(self):
+        print('PZEM-004T:')
+        print('\tName: ' + str(self.name))
+        print('\tUnit: ' + str(self.unit))
+
+    def read(self, now=None):
+        row = self.plan.read(self.client, self.unit)
+        if row is None:
+            return None
+        return InputDecoder.decode(row)
@@ -0,0 +1,145 @@
+from pymodbus.exceptions import ModbusIOException
+from pymodbus.pdu import ExceptionResponse, ModbusExceptions
+
+# Largest register count a single Modbus read may return
+MAX_COUNT = 125
+
+# Largest run of unwanted registers we are prepared to read (and throw away)
+# to save a separate transaction. At 9600 baud a register costs about 2ms on
+# the wire, a transaction's framing and turnaround is usually worth more.
+MAX_GAP = 16
+
+# Exception codes of a unit refusing the addresses of a read, the only ones
+# the plan learns from
+Rejected = (ModbusExceptions.IllegalAddress, ModbusExceptions.IllegalValue)
+
+
+class ReadError(Exception):
+    def __init__(self, address, count, response):
+        super().__init__('Read of %d registers at %d rejected: %s' % (count, address, response))
+        self.address = address
+        self.count = count
+        self.response = response
+
+
+def merge_ranges(ranges):
+    # Sort (address, count) ranges and join the ones that overlap. Touching
+    # ranges are kept apart so a rejected read can still be split between them.
+    merged = []
+    for address, count in sorted(ranges):
+        if merged and address < merged[-1][0] + merged[-1][1]:
+            start, length = merged[-1]
+            merged[-1] = (start, max(length, address + count - start))
+        else:
+            merged.append((address, count))
+    return merged
+
+
+def plan(ranges, max_gap=MAX_GAP, max_count=MAX_COUNT, barriers=()):
+    # Group the wanted ranges into as few reads as possible. A read may bridge
+    # gaps of up to max_gap registers but never crosses an address in barriers.
+    # Returns a list of (address, count, parts) where parts are the wanted
+    # ranges inside that read.
+    blocks = []
+    for address, count in merge_ranges(ranges):
+        # Split ranges that are too long to fit in one read
+        while count > 0:
+            size = min(count, max_count)
+            if blocks:
+                start, length, parts = blocks[-1]
+                end = start + length
+                if address - end <= max_gap and address + size - start <= max_count \
+                        and not any(end <= barrier <= address for barrier in barriers):
+                    parts.append((address, size))
+                    blocks[-1] = (start, address + size - start, parts)
+                    address += size
+                    count -= size
+                    continue
+            blocks.append((address, size, [(address, size)]))
+            address += size
+            count -= size
+    return blocks
+
+
+class ReadPlan:
+    def __init__(self, ranges, input=True, max_gap=MAX_GAP, max_count=MAX_COUNT, barriers=None, unsupported=None):
+        self.ranges = merge_ranges(ranges)
+        self.input = input
+        self.max_gap = max_gap
+        self.max_count = max_count
+        # Addresses the device has refused to let us read across, may be
+        # shared between plans for the same device
+        self.barriers = set() if barriers is None else barriers
+        # Ranges the device rejects as illegal addresses even on their own,
+        # they are left out from then on. Without a set such a range raises
+        # ReadError instead.
+        self.unsupported = unsupported
+        self.size = max(address + count for address, count in self.ranges) if self.ranges else 0
+        self.replan()
+
+    def read_block(self, client, address, count, unit):
+        if self.input:
+            return client.read_input_registers(address, count, unit=unit)
+        return client.read_holding_registers(address, count, unit=unit)
+
+    def split(self, parts):
+        # The device rejected a read spanning these parts. Stop bridging the
+        # widest gap between them, or if they are contiguous cut the read in
+        # half, and keep every other bridge until it is rejected too.
+        start, end = parts[0][0], parts[-1][0] + parts[-1][1]
+        boundaries = [(address - prev - size, -abs(start + end - 2 * address), address)
+                      for (prev, size), (address, _) in zip(parts, parts[1:])]
+        self.barriers.add(max(boundaries)[2])
+        self.replan()
+
+    def replan(self):
+        ranges = self.ranges
+        if self.unsupported:
+            ranges = [part for part in ranges if part not in self.unsupported]
+        self.blocks = plan(ranges, self.max_gap, self.max_count, self.barriers)
+        self.known = self.learned()
+
+    def learned(self):
+        return len(self.barriers), len(self.unsupported or ())
+
+    def read(self, client, unit):
+        # Returns a list indexed by register address covering every wanted
+        # range (unread addresses are 0), or None if the unit did not answer.
+        if self.known != self.learned():
+            # Another plan sharing our barriers learned something new
+            self.replan()
+
+        registers = [0] * self.size
+        blocks = list(self.blocks)
+        while blocks:
+            address, count, parts = blocks.pop(0)
+            row = self.read_block(client, address, count, unit)
+            if type(row) is ModbusIOException:
+                return None
+
+            if row.isError():
+                # Only a rejected address range says something about the
+                # register map. A busy unit, or a gateway whose unit did not
+                # answer, is the same as no answer and the plan stays as is.
+                if not isinstance(row, ExceptionResponse) or row.exception_code not in Rejected:
+                    return None
+                if len(parts) == 1:
+                    if self.unsupported is None:
+                        raise ReadError(address, count, row)
+                    # The barriers learned narrowing the read down to this
+                    # range may all be down to it, start over with a
+                    # barrier at every unsupported range instead
+                    self.unsupported.add(parts[0])
+                    self.barriers.clear()
+                    self.barriers.update(start for start, _ in self.unsupported)
+                    self.replan()
+                    blocks = [block for block in self.blocks if block[0] > address]
+                    continue
+                # Re-plan without this bridge and carry on from the rejected
+                # address, everything before it has already been read
+                self.split(parts)
+                blocks = [block for block in self.blocks if block[0] >= address]
+                continue
+
+            registers[address:address + count] = row.registers[:count]
+        return registers
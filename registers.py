@@ -0,0 +1,64 @@
+import struct
+import sys
+from array import array
+from collections import namedtuple
+
+# One entry of a register map
+#   name:    field name in the decoded sample
+#   address: first register
+#   width:   1 for a 16 bit value, 2 for a 32 bit value
+#   scale:   raw value is divided by this, None keeps the raw integer
+#   unit:    unit of the decoded value, for documentation
+#   codes:   optional (name, table) adding a second field with the looked up text
+Field = namedtuple('Field', ['name', 'address', 'width', 'scale', 'unit', 'codes'], defaults=[None])
+
+Formats = {1: 'H', 2: 'I'}
+
+
+class RegisterDecoder:
+    # Compiles a register map once into a single struct that unpacks every
+    # field of a register block in one call. 32 bit values are high word
+    # first unless low_word_first is set.
+
+    def __init__(self, fields, low_word_first=False):
+        self.fields = sorted(fields, key=lambda field: field.address)
+        self.start = self.fields[0].address if self.fields else 0
+        self.end = self.start
+        self.low_word_first = low_word_first
+
+        formats = []
+        for field in self.fields:
+            if field.address < self.end:
+                raise ValueError('Register %d of %s overlaps the previous field' % (field.address, field.name))
+            if field.address > self.end:
+                formats.append('%dx' % ((field.address - self.end) * 2))
+            formats.append(Formats[field.width])
+            self.end = field.address + field.width
+
+        steps = [(field.name, field.scale) + (field.codes or (None, None)) for field in self.fields]
+        if low_word_first:
+            # Unpack the block back to front, which turns every low/high pair
+            # into a high/low one, and visit the fields in reverse to match
+            formats.reverse()
+            steps.reverse()
+        self.struct = struct.Struct('>' + ''.join(formats))
+        self.steps = steps
+
+    def ranges(self):
+        # (address, count) of every field, for building a ReadPlan
+        return [(field.address, field.width) for field in self.fields]
+
+    def decode(self, registers):
+        # registers is indexed by register address, as returned by ReadPlan.read()
+        block = array('H', registers[self.start:self.end])
+        if self.low_word_first:
+            block.reverse()
+        if sys.byteorder == 'little':
+            block.byteswap()
+
+        info = {}
+        for (name, scale, label, codes), value in zip(self.steps, self.struct.unpack(block.tobytes())):
+            info[name] = value if scale is None else value / scale
+            if codes is not None:
+                info[label] = codes.get(value, 'Unknown: %d' % value)
+        return info
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+# Feeds a capture recorded with --capture back through the decoders and
+# the sinks, as fast as possible or at N times the speed it was recorded
+# at. Points keep the time they were captured at, so with --write this
+# backfills InfluxDB after a decoder fix, through the deadband and rollups
+# of solarmon.cfg. Without --write samples are only decoded and counted,
+# to reproduce field issues or benchmark the pipeline offline.
+#
+#   python3 replay.py solarmon.cap
+#   python3 replay.py solarmon.cap --speed 60 --debug
+#   python3 replay.py solarmon.cap --write
+
+import argparse
+import os
+import time
+from configparser import RawConfigParser
+
+import influxwriter
+from capture import DeviceRecord, ReplayClient, records
+from deadband import Deadband
+from growatt import Growatt
+from influxwriter import InfluxWriter
+from poller import Poller
+from pzem import Pzem
+from rollup import Rollup
+
+
+class Counter:
+    # Sink counting the samples of every device
+    def __init__(self):
+        self.samples = {}
+
+    def put(self, name, point):
+        self.samples[name] = self.samples.get(name, 0) + 1
+
+
+def replay_reader(device, client, rates):
+    if device['kind'] == 'growatt':
+        # The identity is not needed to decode, do not expect it captured
+        return Growatt(client, device['name'], device['unit'], rates, identity={'ModbusVersion': None})
+    return Pzem(client, device['name'], device['unit'])
+
+
+def main(args):
+    settings = RawConfigParser()
+    settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
+    rates = {group: settings.getint('rates', group) for group in settings.options('rates')} \
+        if settings.has_section('rates') else {}
+
+    # The sinks of solarmon.py, fed the way the poller feeds them
+    poller = Poller()
+    counter = Counter()
+    poller.add_sink(counter)
+    writer = None
+    if args.write:
+        writer = InfluxWriter.from_settings(influxwriter.connect(settings), settings, 'replay')
+        poller.add_sink(Deadband.from_settings(writer, settings))
+        poller.add_sink(Rollup.from_settings(writer, settings))
+
+    # Capture device id: (device, client, reader). Ids start over whenever
+    # capturing restarts, the device behind a name keeps its registers.
+    devices = {}
+    by_name = {}
+    offline = 0
+    started = time.perf_counter()
+    first = None
+    for kind, moment, device, value in records(args.capture):
+        if kind == DeviceRecord:
+            if value['name'] not in by_name:
+                client = ReplayClient()
+                by_name[value['name']] = (value, client, replay_reader(value, client, rates))
+            devices[device] = by_name[value['name']]
+            continue
+
+        if args.speed:
+            if first is None:
+                first = moment
+            wait = started + (moment - first) / args.speed - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        if writer is not None:
+            # Never let the writer drop points while backfilling
+            while writer.depth > writer.queue.maxsize // 2:
+                time.sleep(0.01)
+
+        info, client, reader = devices[device]
+        client.poll(value)
+        fields = reader.read(moment)
+        if fields is None:
+            offline += 1
+            continue
+        point = {'time': int(moment), 'measurement': info['measurement'], 'fields': fields}
+        if args.debug:
+            print(info['name'])
+            print(point)
+        poller.emit(info['name'], point)
+    elapsed = time.perf_counter() - started
+
+    samples = sum(counter.samples.values())
+    print('Replayed %d samples of %d devices in %.1f s, %.0f samples/s, %d offline' % (
+        samples, len(by_name), elapsed, samples / elapsed if elapsed else 0, offline))
+    if writer is not None:
+        while writer.depth:
+            time.sleep(0.1)
+        # The last batch goes out after flush_interval
+        time.sleep(writer.flush_interval + 1)
+        print('Wrote %d points, %d failed, %d dropped' % (writer.written, writer.failed, writer.dropped))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='replay a capture through the solarmon pipeline')
+    parser.add_argument('capture', help='file recorded with solarmon.py --capture')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='times the recorded speed, 0 replays as fast as possible')
+    parser.add_argument('--write', action='store_true', help='write the points to InfluxDB')
+    parser.add_argument('--debug', action='store_true', help='print every sample')
+    main(parser.parse_args())
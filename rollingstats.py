@@ -0,0 +1,157 @@
+import math
+from collections import deque
+
+
+class RollingWindow:
+    # Statistics over the last size values in constant time per value: a
+    # ring buffer with running sums for mean and stddev, monotonic queues for
+    # min and max, and an EWMA that defaults to the window's span.
+
+    __slots__ = ('size', 'values', 'index', 'count', 'added', 'sum', 'sumsq',
+                 'lows', 'highs', 'alpha', 'ewma')
+
+    def __init__(self, size, alpha=None):
+        self.size = size
+        self.values = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.added = 0
+        self.sum = 0.0
+        self.sumsq = 0.0
+        # (position, value) pairs, increasing for lows and decreasing for highs
+        self.lows = deque()
+        self.highs = deque()
+        self.alpha = 2 / (size + 1) if alpha is None else alpha
+        self.ewma = None
+
+    def add(self, value):
+        if self.count == self.size:
+            old = self.values[self.index]
+            self.sum -= old
+            self.sumsq -= old * old
+        else:
+            self.count += 1
+        self.values[self.index] = value
+        self.index = (self.index + 1) % self.size
+        self.sum += value
+        self.sumsq += value * value
+
+        position = self.added
+        self.added += 1
+        while self.lows and self.lows[-1][1] >= value:
+            self.lows.pop()
+        self.lows.append((position, value))
+        while self.highs and self.highs[-1][1] <= value:
+            self.highs.pop()
+        self.highs.append((position, value))
+        oldest = self.added - self.count
+        if self.lows[0][0] < oldest:
+            self.lows.popleft()
+        if self.highs[0][0] < oldest:
+            self.highs.popleft()
+
+        self.ewma = value if self.ewma is None else self.ewma + self.alpha * (value - self.ewma)
+
+        # Running sums pick up rounding errors, start them afresh once per window
+        if self.index == 0:
+            self.sum = math.fsum(self.values[:self.count])
+            self.sumsq = math.fsum(v * v for v in self.values[:self.count])
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+    @property
+    def stddev(self):
+        if self.count < 2:
+            return 0.0
+        variance = (self.sumsq - self.sum * self.sum / self.count) / (self.count - 1)
+        return math.sqrt(variance) if variance > 0 else 0.0
+
+    @property
+    def min(self):
+        return self.lows[0][1] if self.lows else 0.0
+
+    @property
+    def max(self):
+        return self.highs[0][1] if self.highs else 0.0
+
+    def fields(self, prefix):
+        return {
+            prefix + 'mean': self.mean,
+            prefix + 'ewma': self.ewma if self.ewma is not None else 0.0,
+            prefix + 'min': self.min,
+            prefix + 'max': self.max,
+            prefix + 'stddev': self.stddev,
+        }
+
+
+class PowerDirection:
+    # Works out whether power flows from (1) or to (-1) the grid by comparing
+    # how inverter output and grid power moved since the last sample
+
+    __slots__ = ('direction', 'lastgrowattpower', 'lastgridpower')
+
+    def __init__(self):
+        self.direction = 1 # 1 - consume power from grid, -1 - supply power to grid.
+        self.lastgrowattpower = 0.0
+        self.lastgridpower = 0.0
+
+    def reset(self):
+        self.lastgrowattpower = 0.0
+        self.direction = 1
+
+    def update(self, growattpower, gridpower):
+        growattpowerdiff = growattpower - self.lastgrowattpower
+        gridpowerdiff = gridpower - self.lastgridpower
+        # If increased growatt power generation increses grid power - we are supplying power to grid:
+        if growattpower < gridpower:
+            self.direction = 1
+        elif growattpowerdiff > 0 and gridpowerdiff > 0:
+            self.direction = -1
+        # If decresed growwat power generation increases grid power - we are also supplying power to grid:
+        elif growattpowerdiff < 0 and gridpowerdiff < 0:
+            self.direction = -1
+        # if power value does not changed - leave as is
+        elif growattpowerdiff == 0 or gridpowerdiff == 0:
+            pass
+        else:
+            self.direction = 1
+        self.lastgrowattpower = growattpower
+        self.lastgridpower = gridpower
+        return growattpowerdiff, gridpowerdiff
+
+
+# Fields GridMetrics needs from the inverter sample and the grid reading
+Joined = frozenset(('Vac1', 'Pac'))
+Grid = frozenset(('Voltage', 'Power'))
+
+
+class GridMetrics:
+    # Fields derived from a grid meter reading and the matching inverter
+    # sample, shared by solarmon-mqtt.py and process_mqtt.py
+
+    def __init__(self, window=5, alpha=None):
+        self.voltagediff = RollingWindow(window, alpha)
+        self.powerdirection = PowerDirection()
+
+    def update(self, energy, growattinfo):
+        voltagediff = 0.0
+        growattpowerdiff = gridpowerdiff = 0.0
+        # Samples built from deadband messages may lack these fields until
+        # the next keyframe, they are no match until then
+        if growattinfo is not None and not Joined.issubset(growattinfo) or not Grid.issubset(energy):
+            growattinfo = None
+        if growattinfo is None:
+            self.powerdirection.reset()
+        else:
+            voltagediff = float(growattinfo['Vac1'] - energy['Voltage'])
+            self.voltagediff.add(voltagediff)
+            growattpowerdiff, gridpowerdiff = self.powerdirection.update(growattinfo['Pac'], energy['Power'])
+
+        fields = self.voltagediff.fields('voltagediff')
+        fields['powerdirection'] = self.powerdirection.direction
+        fields['voltagediff'] = voltagediff
+        fields['gridpowerdiff'] = float(gridpowerdiff)
+        fields['growattpowerdiff'] = float(growattpowerdiff)
+        return fields
@@ -0,0 +1,138 @@
+import time
+
+# Label and length in seconds of the default rollup periods
+Periods = {'1m': 60, '15m': 900, '1d': 86400}
+
+
+def parse_period(value):
+    value = value.strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if value[-1:] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
+
+def bucket_start(now, period):
+    # Buckets are aligned to local time, so daily buckets start at midnight
+    offset = time.localtime(now).tm_gmtoff
+    return now - (now + offset) % period
+
+
+class Bucket:
+    # Aggregates of every field of one device over one period
+
+    __slots__ = ('start', 'end', 'count', 'stats', 'last', 'energy')
+
+    def __init__(self, start, period):
+        self.start = start
+        self.end = start + period
+        self.count = 0
+        # field: [min, max, sum, count]
+        self.stats = {}
+        self.last = {}
+        self.energy = {}
+
+    def add(self, fields):
+        self.count += 1
+        stats = self.stats
+        for field, value in fields.items():
+            self.last[field] = value
+            if type(value) is not int and type(value) is not float:
+                continue
+            stat = stats.get(field)
+            if stat is None:
+                stats[field] = [value, value, value, 1]
+                continue
+            if value < stat[0]:
+                stat[0] = value
+            elif value > stat[1]:
+                stat[1] = value
+            stat[2] += value
+            stat[3] += 1
+
+    def fields(self):
+        fields = {}
+        for field, value in self.last.items():
+            fields[field + '_last'] = value
+        for field, (low, high, total, count) in self.stats.items():
+            fields[field + '_min'] = low
+            fields[field + '_max'] = high
+            fields[field + '_mean'] = total / count
+        for field, joules in self.energy.items():
+            fields[field + '_wh'] = joules / 3600
+        fields['samples'] = self.count
+        return fields
+
+
+class Rollup:
+    # Min, max, mean and last of every field of every device over fixed
+    # periods, plus the trapezoidal integral of the energy fields (power in
+    # W, integral in Wh). A bucket is written as <measurement>_<label> at
+    # its start time once the first sample of the next bucket arrives.
+    # Samples more than max_gap seconds apart are not integrated across.
+
+    def __init__(self, sink, periods=None, energy=('Pac', 'Ppv'), max_gap=60):
+        self.sink = sink
+        self.periods = Periods if periods is None else periods
+        self.energy = energy
+        self.max_gap = max_gap
+        # (device, label): Bucket
+        self.buckets = {}
+        # device: (time, fields) of the previous sample
+        self.previous = {}
+        self.written = 0
+
+    @classmethod
+    def from_settings(cls, sink, settings):
+        if not settings.has_section('rollups'):
+            return cls(sink)
+        periods = settings.get('rollups', 'periods', fallback='1m, 15m, 1d')
+        energy = settings.get('rollups', 'energy', fallback='Pac, Ppv')
+        return cls(sink,
+                   {label.strip(): parse_period(label) for label in periods.split(',') if label.strip()},
+                   [field.strip() for field in energy.split(',') if field.strip()],
+                   settings.getfloat('rollups', 'max_gap', fallback=60))
+
+    def integrate(self, bucket, previous, now, fields):
+        # Adds the area under each energy field between the previous sample
+        # and this one, the part of it inside the bucket
+        then, last = previous
+        start = max(then, bucket.start)
+        end = min(now, bucket.end)
+        if end <= start:
+            return
+        for field in self.energy:
+            v0, v1 = last.get(field), fields.get(field)
+            if v0 is None or v1 is None:
+                continue
+            slope = (v1 - v0) / (now - then)
+            area = (v0 + slope * (start - then) + v0 + slope * (end - then)) / 2 * (end - start)
+            bucket.energy[field] = bucket.energy.get(field, 0.0) + area
+
+    def put(self, name, point):
+        now = point['time']
+        fields = point['fields']
+        previous = self.previous.get(name)
+        if previous is not None and not 0 < now - previous[0] <= self.max_gap:
+            previous = None
+
+        for label, period in self.periods.items():
+            key = (name, label)
+            bucket = self.buckets.get(key)
+            if bucket is not None and now >= bucket.end:
+                if previous is not None:
+                    self.integrate(bucket, previous, now, fields)
+                self.sink.put(name, {
+                    'time': int(bucket.start),
+                    'measurement': '%s_%s' % (point['measurement'], label),
+                    'fields': bucket.fields()
+                })
+                self.written += 1
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[key] = Bucket(bucket_start(now, period), period)
+            if previous is not None:
+                self.integrate(bucket, previous, now, fields)
+            bucket.add(fields)
+
+        self.previous[name] = (now, fields)
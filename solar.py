@@ -0,0 +1,93 @@
+import math
+
+# Days from 1970-01-01 to the J2000 epoch, 2000-01-01 12:00 UTC
+J2000 = 10957.5
+
+
+def sun_times(day, latitude, longitude):
+    # (sunrise, sunset) as unix timestamps of the solar day with number day
+    # since J2000, from the sunrise equation. None for polar night, and
+    # (None, None) for midnight sun. longitude is east positive.
+    mean = day + 0.0008 - longitude / 360
+    anomaly = math.radians((357.5291 + 0.98560028 * mean) % 360)
+    center = 1.9148 * math.sin(anomaly) + 0.0200 * math.sin(2 * anomaly) + 0.0003 * math.sin(3 * anomaly)
+    ecliptic = math.radians((math.degrees(anomaly) + center + 180 + 102.9372) % 360)
+    transit = mean + 0.0053 * math.sin(anomaly) - 0.0069 * math.sin(2 * ecliptic)
+    declination = math.asin(math.sin(ecliptic) * math.sin(math.radians(23.4397)))
+
+    phi = math.radians(latitude)
+    # -0.833 degrees allows for refraction and the size of the sun's disc
+    cos_hour = (math.sin(math.radians(-0.833)) - math.sin(phi) * math.sin(declination)) \
+        / (math.cos(phi) * math.cos(declination))
+    if cos_hour > 1:
+        return None
+    if cos_hour < -1:
+        return None, None
+    hour = math.degrees(math.acos(cos_hour)) / 360
+    return (transit - hour + J2000) * 86400, (transit + hour + J2000) * 86400
+
+
+class SolarSchedule:
+    # Day runs from dawn seconds before sunrise to dusk seconds after
+    # sunset at the configured location, worked out locally
+
+    def __init__(self, latitude, longitude, dawn=1800, dusk=1800, night_interval=1800):
+        self.latitude = latitude
+        self.longitude = longitude
+        self.dawn = dawn
+        self.dusk = dusk
+        self.night_interval = night_interval
+        self.days = {}
+
+    @classmethod
+    def from_settings(cls, settings):
+        # Returns None when no [location] is configured
+        if not settings.has_option('location', 'latitude'):
+            return None
+        return cls(settings.getfloat('location', 'latitude'),
+                   settings.getfloat('location', 'longitude'),
+                   settings.getfloat('location', 'dawn', fallback=30) * 60,
+                   settings.getfloat('location', 'dusk', fallback=30) * 60,
+                   settings.getfloat('location', 'night_interval', fallback=1800))
+
+    def day_number(self, now):
+        # The solar day around now, they change over at local midnight
+        return math.floor(now / 86400 + self.longitude / 360 - J2000 + 0.5)
+
+    def window(self, day):
+        # (start, end) of daytime on a solar day, cached as it only changes daily
+        if day not in self.days:
+            times = sun_times(day, self.latitude, self.longitude)
+            if times is None:
+                window = None
+            elif times[0] is None:
+                start = (day + J2000 - self.longitude / 360 - 0.5) * 86400
+                window = (start, start + 86400)
+            else:
+                window = (times[0] - self.dawn, times[1] + self.dusk)
+            if len(self.days) > 8:
+                self.days.clear()
+            self.days[day] = window
+        return self.days[day]
+
+    def is_day(self, now):
+        window = self.window(self.day_number(now))
+        return window is not None and window[0] <= now < window[1]
+
+    def next_day(self, now):
+        # When daytime next starts, None if not within the next half year
+        day = self.day_number(now)
+        for later in range(day, day + 183):
+            window = self.window(later)
+            if window is not None and window[1] > now:
+                return max(now, window[0])
+        return None
+
+    def night_delay(self, now):
+        # Seconds to wait before probing an offline unit, None during the day
+        if self.is_day(now):
+            return None
+        start = self.next_day(now)
+        if start is None:
+            return self.night_interval
+        return min(self.night_interval, start - now)
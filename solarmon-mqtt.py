@@ -1,18 +1,40 @@
 #!/usr/bin/env python3
 
-import time
-from datetime import datetime
+import argparse
+import asyncio
 import os
-import json
-from decimal import *
-getcontext().prec = 2
 
 from configparser import RawConfigParser
-from influxdb import InfluxDBClient
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 import paho.mqtt.client as mqtt
 
+import influxwriter
+from api import ApiServer
+from capture import Capture, add_arguments as add_capture_arguments
+from deadband import Deadband
+from faults import FaultHistory
 from growatt import Growatt
+from gridmeter import GridMeter
+from history import History
+from identity import IdentityCache, Identified
+from influxwriter import InfluxWriter
+from metrics import Metrics, MetricsServer
+from profiling import Profiler, add_arguments
+from mqttsink import MqttSink
+from payload import Ingest
+from poller import Device, LatestValues, Poller
+from rollup import Rollup
+from stream import Stream
+from solar import SolarSchedule
+from transport import TimedClient, device_bus, load_buses
+
+parser = argparse.ArgumentParser()
+add_arguments(parser)
+add_capture_arguments(parser)
+args = parser.parse_args()
+# Instruments the pipeline before anything is built with --profile
+profiler = Profiler.from_args(args)
+# Raw register blocks of every poll, for replay.py
+capture = Capture.from_args(args)
 
 settings = RawConfigParser()
 settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
@@ -20,36 +42,52 @@ settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
 interval = settings.getint('query', 'interval', fallback=1)
 offline_interval = settings.getint('query', 'offline_interval', fallback=60)
 error_interval = settings.getint('query', 'error_interval', fallback=60)
+backoff = settings.getfloat('query', 'backoff', fallback=5)
+debug = settings.getboolean('query', 'debug', fallback=False)
+
+# Seconds between reads of the slower register groups (energy, fault)
+rates = {group: settings.getint('rates', group) for group in settings.options('rates')} \
+    if settings.has_section('rates') else {}
 
-db_name = settings.get('influx', 'db_name', fallback='inverter')
 measurement = settings.get('influx', 'measurement', fallback='inverter')
 
 broker_address = settings.get('mqtt', 'broker_address', fallback='iot.eclipse.org')
 mqtt_subscribe_pzem = settings.get('mqtt', 'subscribe-pzem', fallback='tele/pzem004t/SENSOR')
 mqtt_subscribe_growatt = settings.get('mqtt', 'subscribe-growatt', fallback='tele/growatt/SENSOR')
-mqtt_measurement = settings.get('mqtt', 'measurement', fallback='grid')
-
-vdiffarr = [0.0] * 5
-
-lastgrowattpower = Decimal('0.0')
-lastgridpower = Decimal('0.0')
-powerdirection = 1 # 1 - consume power from grid, -1 - supply power to grid.
+batch_size = settings.getint('mqtt', 'batch_size', fallback=100)
 
 # Clients
 print('Setup InfluxDB Client... ', end='')
-influx = InfluxDBClient(host=settings.get('influx', 'host', fallback='localhost'),
-                        port=settings.getint('influx', 'port', fallback=8086),
-                        username=settings.get('influx', 'username', fallback=None),
-                        password=settings.get('influx', 'password', fallback=None),
-                        database=db_name)
-influx.create_database(db_name)
+influx = influxwriter.connect(settings)
+writer = InfluxWriter.from_settings(influx, settings, 'solarmon-mqtt')
+# Optionally only send fields that changed, to InfluxDB and to MQTT
+output = Deadband.from_settings(writer, settings)
+mqtt_deadband = Deadband.from_settings(None, settings)
+print('Done!')
+
+print('Setup Serial Connections... ', end='')
+buses = load_buses(settings)
 print('Done!')
 
-print('Setup Serial Connection... ', end='')
-port = settings.get('solarmon', 'port', fallback='/dev/ttyUSB0')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
-print('Dome!')
+poller = Poller(interval, offline_interval, error_interval, debug, backoff, SolarSchedule.from_settings(settings))
+poller.add_sink(output)
+# Aggregates for long range dashboards, taken from the full samples
+poller.add_sink(Rollup.from_settings(writer, settings))
+# Inverter samples are kept here for the MQTT handler to join against
+latest = LatestValues()
+poller.add_sink(latest)
+
+# New entries of the inverters' fault history, written and published as
+# events
+faults = FaultHistory.from_settings(settings)
+if faults is not None:
+    faults.add_sink(writer)
+
+# Identity of every unit, for a warm start
+identities = IdentityCache.from_settings(settings)
+
+# Transaction timing of every device, for the metrics endpoint
+clients = {}
 
 print('Loading inverters... ')
 inverters = []
@@ -60,138 +98,38 @@ for section in settings.sections():
     name = section[10:]
     unit = int(settings.get(section, 'unit'))
     measurement = settings.get(section, 'measurement')
-    growatt = None
-    try:
-        growatt = Growatt(client, name, unit)
-    except Exception as err:
-        print(err)
-
-    inverters.append({
-        'error_sleep': 0,
-        'name': name,
-        'unit': unit,
-        'growatt': growatt,
-        'measurement': measurement
-    })
+    bus = device_bus(buses, settings, section)
+    clients[name] = client = TimedClient(bus.client)
+    if capture is not None:
+        client = capture.client(client)
+    # Built on the first poll, from the cached identity when there is one,
+    # so a unit that is not answering does not hold up the others
+    growatt = Identified(lambda identity, client=client, name=name, unit=unit:
+                         Growatt(client, name, unit, rates, faults, identity),
+                         identities, bus.name, unit, 'growatt')
+    if capture is not None:
+        growatt = capture.reader(growatt, name, 'growatt', unit, measurement)
+    poller.add_device(Device(name, bus, growatt, measurement))
+    inverters.append(name)
 print('Done!')
 
-def process_inverters(now):
-    info = None
-    for inverter in inverters:
-        # If this inverter errored then we wait a bit before trying again
-        if inverter['error_sleep'] > 0:
-            inverter['error_sleep'] -= interval
-            continue
-
-        growatt = inverter['growatt']
-        try:
-            if growatt is None:
-                growatt = Growatt(client, inverter['name'], inverter['unit']) 
-            print(datetime.now().isoformat(timespec='milliseconds'))
-            info = growatt.read()
-
-            if info is None:
-                continue
-           
-            points = [{
-                'time': int(now),
-                'measurement': inverter['measurement'],
-                "fields": info
-            }]
-
-            print(growatt.name)
-            print(info)
-
-            if not influx.write_points(points, time_precision='s'):
-                print("Failed to write to DB!")
-        except Exception as err:
-            print(inverter['name'])
-            print(err)
-            inverter['error_sleep'] = error_interval
-    return info
-
-def on_message(client, userdata, message):
-    global lastgrowattpower
-    global lastgridpower
-    global powerdirection
-    global vdiffarr
-    
-    getcontext().prec = 2
-
-    now = time.time()
-    growattinfo = process_inverters(now)
-
-    payload = str(message.payload.decode("utf-8"))
-    print("message received ", payload)
-    mqtt_message = json.loads(payload)
-    energy = mqtt_message["ENERGY"]
-    energy_parsed = {}
-    for i, (k, v) in enumerate(energy.items()):
-        try:
-            energy_parsed[k] = int(v)
-        except ValueError:
-            try:
-                energy_parsed[k] = float(v)
-            except ValueError:
-                payload = payload
-
-    gridvoltage = Decimal(energy_parsed['Voltage'])
-    growattvoltage = gridvoltage
-    if growattinfo is None:        
-        lastgrowattpower = Decimal('0.0')
-        powerdirection = 1
-    else:
-        growattvoltage = Decimal(growattinfo['Vac1'])       
-        
-        vdiffarr = vdiffarr[1:]+vdiffarr[:1]
-        print("rotated", vdiffarr)
-        vdiffarr[len(vdiffarr)-1] = float(growattvoltage - gridvoltage)
-        print("updated", vdiffarr)
-        
-        growattpower = Decimal(growattinfo['Pac'])
-        gridpower = Decimal(energy_parsed['Power'])
-        growattpowerdiff = growattpower - lastgrowattpower
-        gridpowerdiff = gridpower - lastgridpower
-        print('growattpowerdiff ', growattpowerdiff, 'gridpowerdiff ', gridpowerdiff)
-        # If increased growatt power generation increses grid power - we are supplying power to grid:
-        if (growattpower < gridpower):
-            powerdirection = 1
-        elif (growattpowerdiff > 0 and gridpowerdiff > 0):
-            powerdirection = -1
-        # If decresed growwat power generation increases grid power - we are also supplying power to grid:
-        elif (growattpowerdiff < 0 and gridpowerdiff < 0):
-            powerdirection = -1
-        # if power value does not changed - leave as is
-        elif (growattpowerdiff == 0 or gridpowerdiff == 0):
-            powerdirection = powerdirection
-        else:
-            powerdirection = 1
-        
-        lastgrowattpower = Decimal(growattinfo['Pac'])
-        lastgridpower = Decimal(energy_parsed['Power'])
-        # publish growatt info to mqtt broker also. 
-        mqttmessage = {}
-        mqttmessage["Time"] = datetime.now().isoformat(timespec='milliseconds')
-        mqttmessage["ENERGY"] = growattinfo
-        try:
-            mqttclient.publish(mqtt_subscribe_growatt,json.dumps(mqttmessage)) #publish
-        except:
-            print("Failed to publish mqtt message to broker!")
-            mqttclient.connect(broker_address) # reconect if connection lost.
-            mqttclient.publish(mqtt_subscribe_growatt,json.dumps(mqttmessage)) #publish
-    energy_parsed['powerdirection'] = powerdirection
-    energy_parsed['voltagediff'] = float(growattvoltage - gridvoltage)
-    energy_parsed['voltagediffmean'] = sum(vdiffarr) / len(vdiffarr)
-    energy_parsed['gridpowerdiff'] = float(gridpowerdiff)
-    energy_parsed['growattpowerdiff'] = float(growattpowerdiff)
-        
-    points = [{
-        'time': int(now),
-        'measurement': mqtt_measurement,
-        "fields": energy_parsed
-    }]
-    if not influx.write_points(points, time_precision='s'):
-        print("Failed to write to DB!")
+# The inverter the grid meter readings are joined with
+mqtt_inverter = settings.get('mqtt', 'inverter', fallback=inverters[0] if inverters else None)
+grid = GridMeter.from_settings(settings, latest, mqtt_inverter, interval)
+grid.add_sink(output)
+
+# Local JSON API, recent samples of every device are served from memory
+# and live ones, the grid meter's too, streamed as they come in
+api = ApiServer.from_settings(settings)
+stream = None
+if api is not None:
+    history = History.from_settings(settings, interval)
+    poller.add_sink(history)
+    api.route('history', history.handle)
+    stream = Stream.from_settings(settings)
+    poller.add_sink(stream)
+    grid.add_sink(stream)
+    api.route('stream', stream.handle)
 
 def on_log(client, userdata, level, buf):
     print("log: ",buf)
@@ -199,15 +137,44 @@ def on_log(client, userdata, level, buf):
 
 print('Setup mqtt Connection... ', end='')
 mqttclient = mqtt.Client("SOLARMON")
-mqttclient.on_message=on_message #attach function to callback
+# Messages are parsed in batches on the ingest thread
+ingest = Ingest(batch_size)
+on_message = grid.handle
+if profiler is not None:
+    on_message = profiler.wrap(on_message, 'mqtt message')
+mqttclient.on_message=ingest.callback(on_message) #attach function to callback
+# publish growatt info to mqtt broker also. The topic carries no device
+# name, process_mqtt.py joins it with the grid meter like mqtt_inverter here,
+# so only that inverter is published to it.
+mqtt_sink = MqttSink(mqttclient, mqtt_subscribe_growatt, mqtt_deadband, devices={mqtt_inverter})
+
+def on_connect(client, userdata, flags, rc):
+    mqtt_sink.on_connect(client, userdata, flags, rc)
+    # Subscriptions do not survive a reconnect
+    client.subscribe(mqtt_subscribe_pzem)
+
+mqttclient.on_connect=on_connect
 # mqttclient.on_log=on_log
 mqttclient.connect(broker_address) #connect to broker
 mqttclient.loop_start() #start the loop
-mqttclient.subscribe(mqtt_subscribe_pzem)
+poller.add_sink(mqtt_sink)
+if faults is not None:
+    faults.add_sink(MqttSink(mqttclient, settings.get('faults', 'topic', fallback='tele/growatt/FAULT'),
+                             key='FAULT', event=True))
 print('Done with MQTT!')
-# mqttclient.loop_forever()
 
-while True:
-    time.sleep(offline_interval)
+metrics = Metrics()
+metrics.add_poller(poller)
+metrics.add_clients(clients)
+metrics.add_writer(writer)
+metrics.add_mqtt(mqtt_sink)
+if stream is not None:
+    metrics.add_stream(stream)
+MetricsServer.from_settings(metrics, settings)
+
+if profiler is not None:
+    profiler.start(poller)
+
+asyncio.run(poller.run())
 
 
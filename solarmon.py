@@ -1,13 +1,37 @@
 #!/usr/bin/env python3
 
-import time
+import argparse
+import asyncio
 import os
 
 from configparser import RawConfigParser
-from influxdb import InfluxDBClient
-from pymodbus.client.sync import ModbusSerialClient as ModbusClient
 
+import influxwriter
+from api import ApiServer
+from capture import Capture, add_arguments as add_capture_arguments
+from deadband import Deadband
+from faults import FaultHistory
 from growatt import Growatt
+from history import History
+from identity import IdentityCache, Identified
+from influxwriter import InfluxWriter
+from metrics import Metrics, MetricsServer
+from profiling import Profiler, add_arguments
+from poller import Device, Poller
+from pzem import Pzem
+from rollup import Rollup
+from stream import Stream
+from solar import SolarSchedule
+from transport import TimedClient, device_bus, load_buses
+
+parser = argparse.ArgumentParser()
+add_arguments(parser)
+add_capture_arguments(parser)
+args = parser.parse_args()
+# Instruments the pipeline before anything is built with --profile
+profiler = Profiler.from_args(args)
+# Raw register blocks of every poll, for replay.py
+capture = Capture.from_args(args)
 
 settings = RawConfigParser()
 settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
@@ -15,28 +39,42 @@ settings.read(os.path.dirname(os.path.realpath(__file__)) + '/solarmon.cfg')
 interval = settings.getint('query', 'interval', fallback=1)
 offline_interval = settings.getint('query', 'offline_interval', fallback=60)
 error_interval = settings.getint('query', 'error_interval', fallback=60)
+backoff = settings.getfloat('query', 'backoff', fallback=5)
+debug = settings.getboolean('query', 'debug', fallback=False)
+
+# Seconds between reads of the slower register groups (energy, fault)
+rates = {group: settings.getint('rates', group) for group in settings.options('rates')} \
+    if settings.has_section('rates') else {}
 
-db_name = settings.get('influx', 'db_name', fallback='inverter')
 measurement = settings.get('influx', 'measurement', fallback='inverter')
 
 # Clients
 print('Setup InfluxDB Client... ', end='')
-influx = InfluxDBClient(host=settings.get('influx', 'host', fallback='localhost'),
-                        port=settings.getint('influx', 'port', fallback=8086),
-                        username=settings.get('influx', 'username', fallback=None),
-                        password=settings.get('influx', 'password', fallback=None),
-                        database=db_name)
-influx.create_database(db_name)
+influx = influxwriter.connect(settings)
+writer = InfluxWriter.from_settings(influx, settings, 'solarmon')
+print('Done!')
+
+print('Setup Serial Connections... ', end='')
+buses = load_buses(settings)
 print('Done!')
 
-print('Setup Serial Connection... ', end='')
-port = settings.get('solarmon', 'port', fallback='/dev/ttyUSB0')
-client = ModbusClient(method='rtu', port=port, baudrate=9600, stopbits=1, parity='N', bytesize=8, timeout=1)
-client.connect()
-print('Dome!')
+poller = Poller(interval, offline_interval, error_interval, debug, backoff, SolarSchedule.from_settings(settings))
+poller.add_sink(Deadband.from_settings(writer, settings))
+# Aggregates for long range dashboards, taken from the full samples
+poller.add_sink(Rollup.from_settings(writer, settings))
+
+# New entries of the inverters' fault history, written as events
+faults = FaultHistory.from_settings(settings)
+if faults is not None:
+    faults.add_sink(writer)
+
+# Identity of every unit, for a warm start
+identities = IdentityCache.from_settings(settings)
+
+# Transaction timing of every device, for the metrics endpoint
+clients = {}
 
 print('Loading inverters... ')
-inverters = []
 for section in settings.sections():
     if not section.startswith('inverters.'):
         continue
@@ -44,52 +82,58 @@ for section in settings.sections():
     name = section[10:]
     unit = int(settings.get(section, 'unit'))
     measurement = settings.get(section, 'measurement')
-    growatt = Growatt(client, name, unit)
-    growatt.print_info()
-    inverters.append({
-        'error_sleep': 0,
-        'growatt': growatt,
-        'measurement': measurement
-    })
+    bus = device_bus(buses, settings, section)
+    clients[name] = client = TimedClient(bus.client)
+    if capture is not None:
+        client = capture.client(client)
+    # Built on the first poll, from the cached identity when there is one,
+    # so a unit that is not answering does not hold up the others
+    growatt = Identified(lambda identity, client=client, name=name, unit=unit:
+                         Growatt(client, name, unit, rates, faults, identity),
+                         identities, bus.name, unit, 'growatt')
+    if capture is not None:
+        growatt = capture.reader(growatt, name, 'growatt', unit, measurement)
+    poller.add_device(Device(name, bus, growatt, measurement))
+print('Done!')
+
+print('Loading meters... ')
+for section in settings.sections():
+    if not section.startswith('meters.'):
+        continue
+
+    name = section[7:]
+    unit = settings.getint(section, 'unit')
+    measurement = settings.get(section, 'measurement')
+    bus = device_bus(buses, settings, section)
+    clients[name] = client = TimedClient(bus.client)
+    if capture is not None:
+        client = capture.client(client)
+    meter = Pzem(client, name, unit)
+    meter.print_info()
+    if capture is not None:
+        meter = capture.reader(meter, name, 'pzem', unit, measurement)
+    poller.add_device(Device(name, bus, meter, measurement))
 print('Done!')
 
-while True:
-    online = False
-    for inverter in inverters:
-        # If this inverter errored then we wait a bit before trying again
-        if inverter['error_sleep'] > 0:
-            inverter['error_sleep'] -= interval
-            continue
-
-        growatt = inverter['growatt']
-        try:
-            now = time.time()
-            info = growatt.read()
-
-            if info is None:
-                continue
-
-            # Mark that at least one inverter is online so we should continue collecting data
-            online = True
-
-            points = [{
-                'time': int(now),
-                'measurement': inverter['measurement'],
-                "fields": info
-            }]
-
-            print(growatt.name)
-            print(points)
-
-            if not influx.write_points(points, time_precision='s'):
-                print("Failed to write to DB!")
-        except Exception as err:
-            print(growatt.name)
-            print(err)
-            inverter['error_sleep'] = error_interval
-
-    if online:
-        time.sleep(interval)
-    else:
-        # If all the inverters are not online because no power is being generated then we sleep for 1 min
-        time.sleep(offline_interval)
+metrics = Metrics()
+metrics.add_poller(poller)
+metrics.add_clients(clients)
+metrics.add_writer(writer)
+MetricsServer.from_settings(metrics, settings)
+
+# Local JSON API, recent samples of every device are served from memory
+# and live ones streamed as they are polled
+api = ApiServer.from_settings(settings)
+if api is not None:
+    history = History.from_settings(settings, interval)
+    poller.add_sink(history)
+    api.route('history', history.handle)
+    stream = Stream.from_settings(settings)
+    poller.add_sink(stream)
+    api.route('stream', stream.handle)
+    metrics.add_stream(stream)
+
+if profiler is not None:
+    profiler.start(poller)
+
+asyncio.run(poller.run())
@@ -0,0 +1,158 @@
+import mmap
+import os
+import struct
+
+# File layout: a fixed size header followed by a ring of records. Each
+# record is a 4 byte length and its payload, a zero length marks the point
+# where the writer wrapped back to the start of the ring.
+Header = struct.Struct('<4sIQQQQ')  # magic, version, capacity, head, tail, used
+Length = struct.Struct('<I')
+Magic = b'SPL1'
+Version = 1
+
+
+class Spool:
+    # Append-only, memory-mapped ring of byte records with a fixed size on
+    # disk. When it is full the oldest records are dropped to make room.
+
+    def __init__(self, path, size=64 * 1024 * 1024):
+        self.path = path
+        self.dropped = 0
+
+        exists = os.path.exists(path) and os.path.getsize(path) > Header.size
+        self.file = open(path, 'r+b' if exists else 'w+b')
+        if not exists:
+            self.file.truncate(Header.size + size)
+        self.map = mmap.mmap(self.file.fileno(), 0)
+
+        magic, version, capacity, head, tail, used = Header.unpack_from(self.map, 0)
+        if magic != Magic or version != Version or capacity != len(self.map) - Header.size:
+            # New or unreadable file, start empty
+            capacity, head, tail, used = len(self.map) - Header.size, 0, 0, 0
+        self.capacity = capacity
+        self.head = head
+        self.tail = tail
+        self.used = used
+        self.count = self.scan()
+        self.save()
+
+    @classmethod
+    def from_settings(cls, settings, name):
+        path = settings.get('influx', 'spool', fallback=None)
+        if path is None:
+            path = os.path.join(os.path.dirname(os.path.realpath(__file__)), name + '.spool')
+        if not path:
+            return None
+        return cls(path, settings.getint('influx', 'spool_size', fallback=64) * 1024 * 1024)
+
+    def __len__(self):
+        return self.count
+
+    def save(self):
+        Header.pack_into(self.map, 0, Magic, Version, self.capacity, self.head, self.tail, self.used)
+
+    def flush(self):
+        self.map.flush()
+
+    def scan(self):
+        # Count the records between head and tail, used to recover the count
+        # after a restart
+        count = 0
+        position, remaining = self.head, self.used
+        while remaining > 0:
+            position, size = self.next(position)
+            if size is None:
+                remaining -= self.capacity - position
+                position = 0
+                continue
+            count += 1
+            position += Length.size + size
+            remaining -= Length.size + size
+        return count
+
+    def next(self, position):
+        # Length of the record at position, or None if the ring wraps here
+        if self.capacity - position < Length.size:
+            return position, None
+        size, = Length.unpack_from(self.map, Header.size + position)
+        return position, size or None
+
+    def append(self, data):
+        if not data:
+            return True
+        need = Length.size + len(data)
+        if need > self.capacity:
+            self.dropped += 1
+            return False
+
+        while True:
+            if self.used == 0:
+                self.head = self.tail = 0
+            wrap = self.tail + need > self.capacity
+            pad = self.capacity - self.tail if wrap else 0
+            if self.capacity - self.used >= pad + need:
+                break
+            self.drop()
+
+        if wrap:
+            if pad >= Length.size:
+                Length.pack_into(self.map, Header.size + self.tail, 0)
+            self.used += pad
+            self.tail = 0
+
+        offset = Header.size + self.tail
+        Length.pack_into(self.map, offset, len(data))
+        self.map[offset + Length.size:offset + need] = data
+        self.tail += need
+        self.used += need
+        self.count += 1
+        self.save()
+        return True
+
+    def skip_wrap(self):
+        position, size = self.next(self.head)
+        if size is None and self.used:
+            self.used -= self.capacity - self.head
+            self.head = 0
+
+    def drop(self):
+        self.pop(1)
+        self.dropped += 1
+
+    def peek(self, max_bytes):
+        # Oldest records, at least one and up to max_bytes of payload
+        records = []
+        total = 0
+        position, remaining = self.head, self.used
+        while remaining > 0 and (not records or total < max_bytes):
+            position, size = self.next(position)
+            if size is None:
+                remaining -= self.capacity - position
+                position = 0
+                continue
+            offset = Header.size + position + Length.size
+            records.append(bytes(self.map[offset:offset + size]))
+            total += size
+            position += Length.size + size
+            remaining -= Length.size + size
+        return records
+
+    def pop(self, count):
+        # Remove the count oldest records once they have been delivered
+        for _ in range(count):
+            self.skip_wrap()
+            if self.used == 0:
+                break
+            _, size = self.next(self.head)
+            self.head += Length.size + size
+            self.used -= Length.size + size
+            self.count -= 1
+            self.skip_wrap()
+        if self.used == 0:
+            self.head = self.tail = 0
+        self.save()
+
+    def close(self):
+        self.map.flush()
+        self.map.close()
+        self.file.close()
@@ -0,0 +1,106 @@
+import json
+import threading
+from collections import deque
+
+
+class StreamClient:
+    # Events waiting for one client. The deque is bounded, when the client
+    # falls behind its oldest events are dropped so the poll loop never
+    # waits for it.
+
+    def __init__(self, devices=None, fields=None, size=100):
+        self.devices = devices
+        self.fields = fields
+        self.events = deque(maxlen=size)
+        self.ready = threading.Condition()
+        self.dropped = 0
+
+    def offer(self, name, point):
+        if self.devices is not None and name not in self.devices:
+            return
+        fields = point['fields']
+        if self.fields is not None:
+            fields = {key: value for key, value in fields.items() if key in self.fields}
+            if not fields:
+                return
+        with self.ready:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((name, point['time'], fields))
+            self.ready.notify()
+
+    def take(self, timeout):
+        # Every waiting event, none if nothing came within timeout seconds
+        with self.ready:
+            if not self.events:
+                self.ready.wait(timeout)
+            events = list(self.events)
+            self.events.clear()
+        return events
+
+
+class Stream:
+    # Sink pushing every sample to the clients of /stream as server-sent
+    # events, eg. for wall displays and home automation:
+    #
+    #   /stream?devices=main,grid&fields=Pac,Ppv
+    #
+    # Samples are filtered when they are queued and serialized on the
+    # client's own thread.
+
+    def __init__(self, size=100, keepalive=15):
+        self.size = size
+        self.keepalive = keepalive
+        self.clients = set()
+        self.lock = threading.Lock()
+        # Of the clients that have left, for the metrics endpoint
+        self.dropped = 0
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.getint('api', 'stream_queue', fallback=100))
+
+    def put(self, name, point):
+        with self.lock:
+            clients = list(self.clients)
+        for client in clients:
+            client.offer(name, point)
+
+    def dropped_total(self):
+        with self.lock:
+            return self.dropped + sum(client.dropped for client in self.clients)
+
+    def handle(self, request, path, params):
+        # ApiServer handler for /stream, runs for as long as the client stays
+        devices = params.get('devices')
+        fields = params.get('fields')
+        client = StreamClient(set(devices.split(',')) if devices else None,
+                              set(fields.split(',')) if fields else None, self.size)
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.send_header('Cache-Control', 'no-cache')
+        request.end_headers()
+        with self.lock:
+            self.clients.add(client)
+        try:
+            dropped = 0
+            while True:
+                events = client.take(self.keepalive)
+                lines = []
+                if client.dropped != dropped:
+                    lines.append('event: dropped\ndata: %d\n\n' % (client.dropped - dropped))
+                    dropped = client.dropped
+                for name, moment, values in events:
+                    lines.append('data: %s\n\n' % json.dumps({'device': name, 'time': moment, 'fields': values},
+                                                             separators=(',', ':')))
+                # A comment keeps idle connections open and notices clients
+                # that went away
+                request.wfile.write((''.join(lines) or ': keepalive\n\n').encode())
+                request.wfile.flush()
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.clients.discard(client)
+                self.dropped += client.dropped
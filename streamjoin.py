@@ -0,0 +1,153 @@
+import threading
+from collections import deque
+from datetime import datetime
+
+
+def message_time(message, fallback=None):
+    # Tasmota style payloads carry an ISO 8601 local time in 'Time'
+    try:
+        return datetime.fromisoformat(message['Time']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return fallback
+
+
+class Stream:
+    # Fixed size, time ordered ring of (timestamp, fields) for one topic.
+    # The oldest samples fall out once size is reached.
+
+    def __init__(self, size=600):
+        self.size = size
+        self.times = [0.0] * size
+        self.values = [None] * size
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def index(self, i):
+        return (self.start + i) % self.size
+
+    def time(self, i):
+        return self.times[(self.start + i) % self.size]
+
+    def latest(self):
+        return self.time(self.count - 1) if self.count else None
+
+    def add(self, timestamp, fields):
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+            self.count -= 1
+
+        # Late samples are moved into place, they are rare so a shift is fine
+        i = self.count
+        while i > 0 and self.time(i - 1) > timestamp:
+            self.times[self.index(i)] = self.time(i - 1)
+            self.values[self.index(i)] = self.values[self.index(i - 1)]
+            i -= 1
+        self.times[self.index(i)] = timestamp
+        self.values[self.index(i)] = fields
+        self.count += 1
+
+    def bisect(self, timestamp):
+        # Index of the first sample at or after timestamp
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.time(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def nearest(self, timestamp, window):
+        # Sample closest to timestamp, at most window seconds away
+        i = self.bisect(timestamp)
+        best = None
+        for j in (i - 1, i):
+            if 0 <= j < self.count:
+                distance = abs(self.time(j) - timestamp)
+                if distance <= window and (best is None or distance < best[0]):
+                    best = (distance, j)
+        if best is None:
+            return None
+        return self.time(best[1]), self.values[self.index(best[1])]
+
+    def between(self, start, end):
+        # Samples with start <= timestamp <= end
+        i = self.bisect(start)
+        samples = []
+        while i < self.count and self.time(i) <= end:
+            samples.append((self.time(i), self.values[self.index(i)]))
+            i += 1
+        return samples
+
+
+def mean(samples):
+    # Average of every numeric field over a list of (timestamp, fields)
+    totals = {}
+    for _, fields in samples:
+        for key, value in fields.items():
+            if type(value) in (int, float):
+                totals[key] = totals.get(key, 0) + value
+    return {key: total / len(samples) for key, total in totals.items()}
+
+
+class StreamJoin:
+    # Joins each sample of the left stream with the right stream around the
+    # same time. A left sample is held until the right stream has moved past
+    # it, or until it is lateness seconds behind the newest data, so late
+    # right samples can still be matched. With mode 'nearest' the closest
+    # right sample within window seconds is used, with 'window' the mean of
+    # all right samples within window seconds either side.
+
+    def __init__(self, on_join, window=2, lateness=2, mode='nearest', size=600):
+        self.on_join = on_join
+        self.window = window
+        self.lateness = lateness
+        self.mode = mode
+        self.left = Stream(size)
+        self.right = Stream(size)
+        self.pending = deque(maxlen=size)
+        self.lock = threading.Lock()
+        self.joined = 0
+        self.unmatched = 0
+
+    def match(self, timestamp):
+        if self.mode == 'window':
+            samples = self.right.between(timestamp - self.window, timestamp + self.window)
+            return mean(samples) if samples else None
+        sample = self.right.nearest(timestamp, self.window)
+        return None if sample is None else sample[1]
+
+    def ready(self, timestamp, now):
+        latest = self.right.latest()
+        horizon = timestamp + (self.window if self.mode == 'window' else 0)
+        return (latest is not None and latest >= horizon) or timestamp + self.lateness <= now
+
+    def release(self, now):
+        # Called with the lock held, so joins run one at a time in order
+        while self.pending and self.ready(self.pending[0][0], now):
+            timestamp, fields = self.pending.popleft()
+            other = self.match(timestamp)
+            if other is None:
+                self.unmatched += 1
+            else:
+                self.joined += 1
+            self.on_join(timestamp, fields, other)
+
+    def add_left(self, timestamp, fields):
+        with self.lock:
+            self.left.add(timestamp, fields)
+            self.pending.append((timestamp, fields))
+            self.release(max(timestamp, self.right.latest() or timestamp))
+
+    def add_right(self, timestamp, fields):
+        with self.lock:
+            self.right.add(timestamp, fields)
+            self.release(max(timestamp, self.left.latest() or timestamp))
+
+    def expire(self, now):
+        # Flush samples that waited longer than lateness, for quiet periods
+        with self.lock:
+            self.release(now)
@@ -0,0 +1,96 @@
+import time
+
+import pytest
+from influxdb import InfluxDBClient
+
+from bench.influxstub import InfluxStub
+from influxwriter import InfluxWriter
+from spool import Spool
+
+
+def wait(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.02)
+    return True
+
+
+def points(count, start=0):
+    return [{'measurement': 'inverter', 'time': 1700000000 + start + index, 'fields': {'Pac': float(index)}}
+            for index in range(count)]
+
+
+@pytest.fixture
+def stub():
+    stub = InfluxStub()
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def writer(stub, tmp_path):
+    influx = InfluxDBClient(port=stub.port, database='inverter', timeout=2, retries=1)
+    spool = Spool(str(tmp_path / 'test.spool'), 1024 * 1024)
+    return InfluxWriter(influx, batch_size=10, flush_interval=0.05, spool=spool,
+                        retry_interval=0.2, max_retry_interval=0.2)
+
+
+def write(writer, batch):
+    for point in batch:
+        writer.write(point)
+
+
+def test_spools_and_replays_while_database_is_down(stub, writer):
+    stub.stop()
+    write(writer, points(25))
+    assert wait(lambda: len(writer.spool) == 3)
+    assert writer.written == 0 and writer.write_failures > 0
+
+    stub.start()
+    assert wait(lambda: not writer.pending())
+    assert writer.replayed == 3
+    assert stub.points == 25
+    assert writer.rejected == 0
+
+
+def test_spools_and_replays_on_server_errors(stub, writer):
+    stub.status = 500
+    write(writer, points(10))
+    assert wait(lambda: len(writer.spool) == 1)
+    assert stub.points == 0
+
+    stub.status = 204
+    assert wait(lambda: not writer.pending())
+    assert stub.points == 10
+
+
+def test_drops_rejected_batches(stub, writer):
+    stub.status = 400
+    write(writer, points(10))
+    assert wait(lambda: writer.rejected == 10)
+    assert not writer.pending()
+
+    # The database is up, the next batch is written right away
+    stub.status = 204
+    write(writer, points(10, 10))
+    assert wait(lambda: writer.written == 10)
+    assert stub.points == 10
+
+
+def test_drops_rejected_replay_chunks(stub, writer):
+    stub.stop()
+    write(writer, points(20))
+    assert wait(lambda: len(writer.spool) == 2)
+
+    stub.status = 400
+    stub.start()
+    assert wait(lambda: not writer.pending())
+    assert writer.rejected == 20
+    assert writer.replayed == 0
+
+    stub.status = 204
+    write(writer, points(10, 20))
+    assert wait(lambda: writer.written == 10)
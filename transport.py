@@ -0,0 +1,358 @@
+import math
+import queue
+import threading
+import time
+from collections import deque
+
+from pymodbus.client.sync import ModbusSerialClient, ModbusTcpClient
+from pymodbus.exceptions import ConnectionException, ModbusIOException
+from pymodbus.pdu import ExceptionResponse
+from pymodbus.transaction import ModbusRtuFramer, ModbusSocketFramer
+
+from metrics import Histogram
+from poller import Bus
+
+# Framers for the transports a bus can use over TCP
+Framers = {
+    'tcp': ModbusSocketFramer,
+    'rtu-over-tcp': ModbusRtuFramer,
+}
+
+
+class UnitTiming:
+    # What we have learned about how one unit answers. Latencies are kept
+    # without the time the frames take on the line, so one estimate covers
+    # reads of any size. The timeout is their p99 times factor plus margin,
+    # the configured timeout until enough answers have been seen. A unit
+    # missing asleep_after answers in a row is taken to be asleep, reads
+    # then fail without touching the bus except for a probe every
+    # probe_interval seconds. A missed answer drops the learned timeout, so
+    # the next reads and probes wait the configured timeout again and a
+    # unit that got slower is learned anew. gap is extra quiet time before
+    # a request, raised when a unit that is awake garbles or misses an
+    # answer and decayed on every good one.
+
+    Window = 100
+    Learn = 10
+
+    def __init__(self, timeout=1, min_timeout=0.1, factor=1.5, margin=0.05,
+                 asleep_after=2, probe_interval=30, max_gap=0.1):
+        self.max_timeout = timeout
+        self.min_timeout = min_timeout
+        self.factor = factor
+        self.margin = margin
+        self.asleep_after = asleep_after
+        self.probe_interval = probe_interval
+        self.max_gap = max_gap
+        self.latencies = deque(maxlen=self.Window)
+        self.learned = 0
+        self.extra = None
+        self.failures = 0
+        self.asleep_until = 0
+        self.gap = 0.0
+
+    def timeout(self, line_time):
+        if self.extra is None:
+            return self.max_timeout
+        # Rounded up to 10ms so the port is not reconfigured for every read
+        timeout = math.ceil((line_time + self.extra) * 100) / 100
+        return min(self.max_timeout, max(self.min_timeout, timeout))
+
+    def asleep(self, now):
+        # True while reads should fail fast, let a probe through when it is due
+        if self.failures < self.asleep_after or now >= self.asleep_until:
+            return False
+        return True
+
+    def answered(self, latency):
+        self.latencies.append(latency)
+        self.learned += 1
+        if self.learned >= self.Learn and self.learned % self.Learn == 0:
+            ordered = sorted(self.latencies)
+            self.extra = ordered[int(0.99 * (len(ordered) - 1))] * self.factor + self.margin
+        self.failures = 0
+        self.gap *= 0.9
+
+    def missed(self, now, garbled=False):
+        if self.failures == 0 and (garbled or self.learned):
+            # It was answering, maybe the line needs more rest between frames
+            self.gap = min(self.max_gap, max(self.gap * 2, 0.005))
+        if not garbled:
+            # The answer may only have been slower than the learned timeout
+            self.latencies.clear()
+            self.learned = 0
+            self.extra = None
+        self.failures += 1
+        if self.failures >= self.asleep_after:
+            self.asleep_until = now + self.probe_interval
+
+
+def line_time(client, count):
+    # Seconds a read request and its answer of count registers take on a
+    # serial line, 10 bits per byte. Nothing for TCP.
+    baudrate = getattr(client, 'baudrate', None)
+    if not baudrate:
+        return 0.0
+    return (8 + 5 + 2 * count) * 10 / baudrate
+
+
+def set_timeout(client, timeout):
+    client.timeout = timeout
+    socket = getattr(client, 'socket', None)
+    if socket is None:
+        return
+    if hasattr(socket, 'settimeout'):
+        socket.settimeout(timeout)
+    else:
+        # pyserial applies this right away
+        socket.timeout = timeout
+
+
+class ReconnectingClient:
+    # Wraps a pymodbus client, reconnecting with exponential backoff. While
+    # the connection is down reads fail fast with a ModbusIOException, the
+    # same as a unit that does not answer, instead of raising. With timings
+    # every request gets the timeout and gap learned for its unit.
+
+    def __init__(self, client, min_backoff=1, max_backoff=60, timings=None):
+        self.client = client
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.backoff = min_backoff
+        self.retry_at = 0
+        self.reconnects = 0
+        # unit: UnitTiming, may be shared by the connections of a pool
+        self.timings = timings
+        self.timeout = None
+        self.last_end = 0
+
+    def connect(self):
+        if self.client.is_socket_open():
+            return True
+        if time.monotonic() < self.retry_at:
+            return False
+        if self.client.connect():
+            self.backoff = self.min_backoff
+            self.reconnects += 1
+            return True
+        self.disconnect()
+        return False
+
+    def disconnect(self):
+        self.client.close()
+        self.retry_at = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff * 2, self.max_backoff)
+
+    def call(self, method, *args, **kwargs):
+        if not self.connect():
+            return ModbusIOException('Not connected to %s' % self.client)
+        try:
+            return getattr(self.client, method)(*args, **kwargs)
+        except ConnectionException as err:
+            self.disconnect()
+            return ModbusIOException(str(err))
+
+    def read(self, method, address, count, unit=1):
+        if self.timings is None:
+            return self.call(method, address, count, unit=unit)
+
+        timing = self.timings.get(unit)
+        now = time.monotonic()
+        if timing.asleep(now):
+            return ModbusIOException('Unit %d is asleep' % unit)
+
+        expected = line_time(self.client, count)
+        timeout = timing.timeout(expected)
+        if timeout != self.timeout and self.connect():
+            set_timeout(self.client, timeout)
+            self.timeout = timeout
+        wait = self.last_end + timing.gap - now
+        if wait > 0:
+            time.sleep(wait)
+
+        started = time.monotonic()
+        response = self.call(method, address, count, unit=unit)
+        self.last_end = time.monotonic()
+        if not response.isError() or isinstance(response, ExceptionResponse):
+            timing.answered(max(0.0, self.last_end - started - expected))
+            return response
+
+        response.kind = error_kind(response, self.last_end - started, timeout)
+        if response.kind != 'disconnected':
+            timing.missed(self.last_end, response.kind == 'crc')
+        return response
+
+    def read_input_registers(self, address, count=1, unit=1):
+        return self.read('read_input_registers', address, count, unit)
+
+    def read_holding_registers(self, address, count=1, unit=1):
+        return self.read('read_holding_registers', address, count, unit)
+
+    def close(self):
+        self.client.close()
+
+
+class Timings:
+    # UnitTiming of every unit on a bus, created on first use
+    def __init__(self, **options):
+        self.options = options
+        self.units = {}
+        self.lock = threading.Lock()
+
+    def get(self, unit):
+        timing = self.units.get(unit)
+        if timing is None:
+            with self.lock:
+                timing = self.units.setdefault(unit, UnitTiming(**self.options))
+        return timing
+
+
+class ClientPool:
+    # Persistent connections to one endpoint. Each read checks a connection
+    # out for the length of the transaction, so up to size requests can be
+    # in flight at once on gateways that accept several connections.
+
+    def __init__(self, factory, size=1, timings=None):
+        self.size = size
+        self.timings = timings
+        self.clients = queue.Queue()
+        for _ in range(size):
+            client = ReconnectingClient(factory(), timings=timings)
+            self.clients.put(client)
+        # The configured timeout, the longest any read waits
+        self.timeout = client.client.timeout
+
+    def call(self, method, *args, **kwargs):
+        client = self.clients.get()
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        finally:
+            self.clients.put(client)
+
+    def read_input_registers(self, *args, **kwargs):
+        return self.call('read_input_registers', *args, **kwargs)
+
+    def read_holding_registers(self, *args, **kwargs):
+        return self.call('read_holding_registers', *args, **kwargs)
+
+
+def bus_timings(settings, section):
+    # Learned timeouts are on unless adaptive = false, the configured
+    # timeout is their ceiling
+    if not settings.getboolean(section, 'adaptive', fallback=True):
+        return None
+    return Timings(timeout=settings.getfloat(section, 'timeout', fallback=1),
+                   min_timeout=settings.getfloat(section, 'min_timeout', fallback=0.1),
+                   margin=settings.getfloat(section, 'timeout_margin', fallback=0.05),
+                   asleep_after=settings.getint(section, 'asleep_after', fallback=2),
+                   probe_interval=settings.getfloat(section, 'probe_interval', fallback=30))
+
+
+def error_kind(response, elapsed=None, timeout=None):
+    # Errors from a ReconnectingClient with timings already carry their kind
+    kind = getattr(response, 'kind', None)
+    if kind is not None:
+        return kind
+    if isinstance(response, ExceptionResponse):
+        return 'exception'
+    message = str(response)
+    if 'Not connected' in message:
+        return 'disconnected'
+    if 'is asleep' in message:
+        return 'asleep'
+    # pymodbus says 'unable to decode' both for a unit that stayed silent
+    # and for an answer that failed its CRC, only the time tells them apart
+    if 'Unable to decode' in message and elapsed is not None and timeout and elapsed < timeout * 0.9:
+        return 'crc'
+    return 'timeout'
+
+
+class TimedClient:
+    # Wraps the client of one device, timing its transactions and counting
+    # failed ones by kind, for the metrics endpoint
+
+    def __init__(self, client):
+        self.client = client
+        self.latency = Histogram()
+        self.errors = {}
+
+    def call(self, method, *args, **kwargs):
+        started = time.perf_counter()
+        response = getattr(self.client, method)(*args, **kwargs)
+        elapsed = time.perf_counter() - started
+        self.latency.observe(elapsed)
+        if response.isError():
+            kind = error_kind(response, elapsed, getattr(self.client, 'timeout', None))
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+        return response
+
+    def read_input_registers(self, *args, **kwargs):
+        return self.call('read_input_registers', *args, **kwargs)
+
+    def read_holding_registers(self, *args, **kwargs):
+        return self.call('read_holding_registers', *args, **kwargs)
+
+
+def serial_client(settings, section, port=None):
+    return ModbusSerialClient(method='rtu',
+                              port=settings.get(section, 'port', fallback=port),
+                              baudrate=settings.getint(section, 'baudrate', fallback=9600),
+                              parity=settings.get(section, 'parity', fallback='N'),
+                              stopbits=settings.getint(section, 'stopbits', fallback=1),
+                              bytesize=settings.getint(section, 'bytesize', fallback=8),
+                              timeout=settings.getfloat(section, 'timeout', fallback=1))
+
+
+def tcp_client(settings, section, transport):
+    return ModbusTcpClient(settings.get(section, 'host'),
+                           port=settings.getint(section, 'port', fallback=502),
+                           framer=Framers[transport],
+                           timeout=settings.getfloat(section, 'timeout', fallback=1))
+
+
+# Buses pointing at the same gateway share its connections
+pools = {}
+pools_lock = threading.Lock()
+
+
+def bus_client(settings, section, port=None):
+    transport = settings.get(section, 'transport', fallback='rtu')
+    if transport == 'rtu':
+        return ClientPool(lambda: serial_client(settings, section, port), timings=bus_timings(settings, section))
+    if transport not in Framers:
+        raise ValueError('[%s] unknown transport %s' % (section, transport))
+
+    key = (transport, settings.get(section, 'host'), settings.getint(section, 'port', fallback=502))
+    with pools_lock:
+        if key not in pools:
+            pools[key] = ClientPool(lambda: tcp_client(settings, section, transport),
+                                    settings.getint(section, 'connections', fallback=1),
+                                    bus_timings(settings, section))
+        return pools[key]
+
+
+def load_buses(settings):
+    # Every [bus.<name>] section is its own line with its own worker, so
+    # buses are polled in parallel. Without any, [solarmon] port is used
+    # as the single 'main' bus.
+    buses = {}
+    for section in settings.sections():
+        if not section.startswith('bus.'):
+            continue
+        name = section[4:]
+        client = bus_client(settings, section)
+        buses[name] = Bus(name, client, workers=client.size)
+
+    if not buses:
+        buses['main'] = Bus('main', bus_client(settings, 'solarmon', port='/dev/ttyUSB0'))
+    return buses
+
+
+def device_bus(buses, settings, section):
+    # Devices without a bus option use the first configured bus
+    name = settings.get(section, 'bus', fallback=None)
+    if name is None:
+        return next(iter(buses.values()))
+    if name not in buses:
+        raise KeyError('[%s] refers to unknown bus %s' % (section, name))
+    return buses[name]